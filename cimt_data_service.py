@@ -0,0 +1,731 @@
+'''
+cimt_data_service.py
+Climate Impact Metrics Tool 'data service' file
+
+A small long-running service which keeps the cubes loaded by ImpactMetric.load_modify_cubes() for recently
+used (metric, runid, years, period) keys, so that notebooks don't reload the same .pp files after each
+kernel restart. By default each analyst on a shared server runs their own service. A service can also be
+shared by the members of a Unix group, so that analysts working on the same runs hold one copy of the cubes
+between them instead of one each.
+
+The data arrays are not sent over the socket. They are written once to .npy files in a shared memory
+spool directory and memory-mapped copy-on-write by the clients, so every client shares the same pages.
+The cube metadata is sent as JSON, nothing received by the service or its clients is unpickled. The
+spool is kept within an LRU memory budget.
+
+By default only the user who started the service can use it:
+- clients must present the secret in the key file (~/.cimt_data_service_key by default, created with
+  mode 0600 the first time the service starts),
+- the socket and the spool are kept in directories only that user can read (mode 0700), by default
+  /tmp/cimt-<uid> and /dev/shm/cimt-<uid>.
+
+With --group (and 'group' in [data_service]) only the members of that Unix group can use it:
+- the key file is readable by the group only (mode 0640), by default /tmp/cimt-group-<gid>/data_service.key,
+- the socket is kept in /tmp/cimt-group-<gid> (mode 0750) and the spool in /dev/shm/cimt-group-<gid>
+  (mode 2770, as every member writes the cubes they load into it). No one outside the group can read
+  either, but the members trust each other: any of them can replace the cubes the others are served.
+
+Start the service (e.g. in a screen session on the shared server):
+    python cimt_data_service.py --budget 8192
+    python cimt_data_service.py --budget 8192 --group <unix group>      (shared by the group)
+
+Then set 'mode = client' (and the group, if any) in the [data_service] section of 'cimt_interface.ini'.
+If the service isn't running (or can't be used) the tool falls back to loading the files directly.
+'''
+
+import os
+import grp
+import stat
+import json
+import base64
+import shutil
+import uuid
+import argparse
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener , Client
+
+import numpy as np
+import iris
+import iris.coords
+import iris.coord_systems
+import iris.cube
+import iris.fileformats.pp as pp
+
+try:
+    from cf_units import Unit
+except ImportError: # Iris 1.x
+    from iris.unit import Unit
+
+default_key_file = os.path.join( '~' , '.cimt_data_service_key' )
+default_budget = 4096 # MB
+
+shared_array_min_bytes = 1024 # Smaller arrays (e.g. coordinates) are sent in the JSON
+max_message_bytes = 64 * 1024 ** 2
+
+# ----------------------------------------------------------------------------------------------------
+
+class DataServiceError( StandardError ):
+    """
+    Raised when the service can't be used safely, e.g. a missing key file or a directory others can read.
+    """
+    pass
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for the per-user (or per-group) secret and directories -----------------------------------
+
+def group_id( group ):
+    """
+    Returns the id of a Unix group given by name, or None for a per-user service (group = None).
+    """
+    if group == None:
+        return None
+    try:
+        return grp.getgrnam( group ).gr_gid
+    except KeyError:
+        raise DataServiceError( 'No Unix group named ' + group )
+
+# ----------------------------------------------------------------------------------------------------
+
+def runtime_dir( group = None ):
+    """
+    Returns the private runtime directory of the user, /tmp/cimt-<uid>, or of the group, /tmp/cimt-group-<gid>.
+    """
+    if group == None:
+        return os.path.join( '/tmp' , 'cimt-' + str( os.getuid() ) )
+    return os.path.join( '/tmp' , 'cimt-group-' + str( group_id( group ) ) )
+
+# ----------------------------------------------------------------------------------------------------
+
+def default_address( group = None ):
+    """
+    Returns the path of the socket in the private runtime directory of the user (or group).
+    """
+    return os.path.join( runtime_dir( group ) , 'data_service.sock' )
+
+# ----------------------------------------------------------------------------------------------------
+
+def default_spool_dir( group = None ):
+    """
+    Returns the private shared memory spool directory of the user, /dev/shm/cimt-<uid>, or of the group,
+    /dev/shm/cimt-group-<gid>.
+    """
+    if group == None:
+        return os.path.join( '/dev/shm' , 'cimt-' + str( os.getuid() ) )
+    return os.path.join( '/dev/shm' , 'cimt-group-' + str( group_id( group ) ) )
+
+# ----------------------------------------------------------------------------------------------------
+
+def private_dir( path , create = False , group = None , group_write = False ):
+    """
+    Checks that a directory belongs to the user and that no one else can access it (mode 0700), or for a
+    group service that it belongs to the group and no one outside the group can access it, creating it
+    first if asked.
+
+    Parameters
+    ----------
+    path : string
+        The directory.
+
+    create : boolean
+        Create the directory if it doesn't exist.
+        Default setting: create = False.
+
+    group : string
+        Name of the Unix group of a shared service.
+        Default setting: group = None (a per-user service).
+
+    group_write : boolean
+        For a group service, the members can write to the directory (mode 2770, e.g. the spool), otherwise
+        only its owner can (mode 0750).
+        Default setting: group_write = False.
+
+    Returns
+    -------
+    string
+        The path.
+    """
+    gid = group_id( group )
+
+    if create and not os.path.lexists( path ):
+        os.mkdir( path , 0700 )
+        if gid != None: # New files in the directory take its group
+            os.chown( path , -1 , gid )
+            os.chmod( path , 02770 if group_write else 0750 )
+
+    try:
+        info = os.lstat( path )
+    except OSError as error:
+        raise DataServiceError( 'Data service directory ' + path + ' not found: ' + str( error ) )
+    if not stat.S_ISDIR( info.st_mode ):
+        raise DataServiceError( path + ' must be a directory, not a link or a file' )
+
+    if gid == None:
+        if info.st_uid != os.getuid() or info.st_mode & 0077:
+            raise DataServiceError( path + ' must be a directory owned by you with mode 0700, not a link or shared directory' )
+    elif info.st_gid != gid or info.st_mode & ( 0007 if group_write else 0027 ):
+        raise DataServiceError( path + ' must be a directory of group ' + group + ' with mode ' + ( '2770' if group_write else '0750' ) )
+
+    return path
+
+# ----------------------------------------------------------------------------------------------------
+
+def read_authkey( key_file = None , create = False , group = None ):
+    """
+    Reads the secret of the user from the key file, which must have mode 0600, or for a group service the
+    secret of the group, which must have mode 0640. The service creates a new random key the first time it
+    starts, clients only read it.
+
+    Returns
+    -------
+    string
+        The key.
+    """
+    gid = group_id( group )
+    if key_file == None:
+        key_file = default_key_file if gid == None else os.path.join( runtime_dir( group ) , 'data_service.key' )
+    key_file = os.path.expanduser( key_file )
+
+    if create and not os.path.lexists( key_file ):
+        descriptor = os.open( key_file , os.O_WRONLY | os.O_CREAT | os.O_EXCL , 0600 )
+        if gid != None: # Readable by the members of the group only
+            os.fchown( descriptor , -1 , gid )
+            os.fchmod( descriptor , 0640 )
+        with os.fdopen( descriptor , 'w' ) as key:
+            key.write( base64.b16encode( os.urandom( 32 ) ) )
+
+    try:
+        info = os.lstat( key_file )
+    except OSError:
+        raise DataServiceError( 'No data service key file ' + key_file + ', start the service first' )
+    if not stat.S_ISREG( info.st_mode ):
+        raise DataServiceError( 'The key file ' + key_file + ' must be a file, not a link' )
+    if gid == None and ( info.st_uid != os.getuid() or info.st_mode & 0077 ):
+        raise DataServiceError( 'The key file ' + key_file + ' must be a file owned by you with mode 0600' )
+    if gid != None and ( info.st_gid != gid or info.st_mode & 0037 ):
+        raise DataServiceError( 'The key file ' + key_file + ' must be a file of group ' + group + ' with mode 0640' )
+
+    with open( key_file ) as key:
+        authkey = key.read().strip()
+    if len( authkey ) < 32:
+        raise DataServiceError( 'The key in ' + key_file + ' is too short' )
+
+    return authkey
+
+# ----------------------------------------------------------------------------------------------------
+
+def parse_address( address ):
+    """
+    Returns a multiprocessing address: a path for a Unix socket or a ( host , port ) tuple for 'host:port'.
+    """
+    if not address.startswith( '/' ) and ':' in address:
+        host , port = address.rsplit( ':' , 1 )
+        return ( host , int( port ) )
+    return address
+
+# ----------------------------------------------------------------------------------------------------
+
+def send_message( connection , message ):
+    """
+    Sends a message as JSON, never as a pickle.
+    """
+    connection.send_bytes( json.dumps( message ) )
+
+# ----------------------------------------------------------------------------------------------------
+
+def recv_message( connection ):
+    """
+    Receives a message sent by send_message().
+    """
+    return json.loads( connection.recv_bytes( max_message_bytes ) )
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for passing cubes through the shared memory spool ----------------------------------------
+
+def encode_array( array , save_array = None ):
+    """
+    Describes a numpy (or masked) array for JSON: large arrays are saved with save_array() and referred to
+    by file name, small ones are included as base64. Object arrays are refused.
+    """
+    if isinstance( array , np.ma.MaskedArray ):
+        return { 'masked' : encode_array( array.data , save_array ) , 'mask' : encode_array( np.ma.getmaskarray( array ) , save_array ) ,
+                 'fill_value' : encode_value( array.fill_value ) }
+
+    array = np.asarray( array )
+    if array.dtype.hasobject:
+        raise ValueError( 'Arrays of objects can not be passed through the data service' )
+    if save_array != None and array.nbytes >= shared_array_min_bytes:
+        return { 'file' : save_array( array ) }
+    return { 'dtype' : array.dtype.str , 'shape' : list( array.shape ) , 'bytes' : base64.b64encode( np.ascontiguousarray( array ).tostring() ) }
+
+# ----------------------------------------------------------------------------------------------------
+
+def decode_array( value , load_array = None ):
+    """
+    Rebuilds an array described by encode_array().
+    """
+    if 'masked' in value:
+        return np.ma.MaskedArray( decode_array( value['masked'] , load_array ) , mask = decode_array( value['mask'] , load_array ) ,
+                                  fill_value = decode_value( value['fill_value'] ) )
+    if 'file' in value:
+        return load_array( value['file'] )
+
+    dtype = np.dtype( str( value['dtype'] ) )
+    if dtype.hasobject:
+        raise ValueError( 'Arrays of objects can not be passed through the data service' )
+    return np.frombuffer( base64.b64decode( value['bytes'] ) , dtype = dtype ).reshape( value['shape'] ).copy()
+
+# ----------------------------------------------------------------------------------------------------
+
+def encode_value( value ):
+    """
+    Describes an attribute value for JSON, refusing types which can't be rebuilt safely.
+    """
+    if value is None or isinstance( value , ( bool , int , long , float , basestring ) ):
+        return value
+    if isinstance( value , np.generic ):
+        return value.item()
+    if isinstance( value , pp.STASH ):
+        return { 'stash' : str( value ) }
+    if isinstance( value , np.ndarray ):
+        return { 'array' : encode_array( value ) }
+    if isinstance( value , ( list , tuple ) ):
+        return [ encode_value( item ) for item in value ]
+    raise ValueError( 'Values of type ' + type( value ).__name__ + ' can not be passed through the data service' )
+
+# ----------------------------------------------------------------------------------------------------
+
+def decode_value( value ):
+    """
+    Rebuilds a value described by encode_value(), JSON strings are returned as str.
+    """
+    if isinstance( value , unicode ):
+        return value.encode( 'utf-8' )
+    if isinstance( value , list ):
+        return [ decode_value( item ) for item in value ]
+    if isinstance( value , dict ):
+        if 'stash' in value:
+            return pp.STASH.from_msi( str( value['stash'] ) )
+        return decode_array( value['array'] )
+    return value
+
+# ----------------------------------------------------------------------------------------------------
+
+def encode_coord_system( coord_system ):
+    """
+    Describes the (rotated) latitude-longitude coordinate systems of UM output for JSON.
+    """
+    if coord_system is None:
+        return None
+    if isinstance( coord_system , iris.coord_systems.RotatedGeogCS ):
+        return { 'class' : 'RotatedGeogCS' , 'grid_north_pole_latitude' : coord_system.grid_north_pole_latitude ,
+                 'grid_north_pole_longitude' : coord_system.grid_north_pole_longitude ,
+                 'north_pole_grid_longitude' : coord_system.north_pole_grid_longitude ,
+                 'ellipsoid' : encode_coord_system( coord_system.ellipsoid ) }
+    if isinstance( coord_system , iris.coord_systems.GeogCS ):
+        return { 'class' : 'GeogCS' , 'semi_major_axis' : coord_system.semi_major_axis , 'semi_minor_axis' : coord_system.semi_minor_axis ,
+                 'longitude_of_prime_meridian' : coord_system.longitude_of_prime_meridian }
+    raise ValueError( 'Coordinate systems of type ' + type( coord_system ).__name__ + ' can not be passed through the data service' )
+
+# ----------------------------------------------------------------------------------------------------
+
+def decode_coord_system( value ):
+    """
+    Rebuilds a coordinate system described by encode_coord_system().
+    """
+    if value is None:
+        return None
+    if value['class'] == 'RotatedGeogCS':
+        return iris.coord_systems.RotatedGeogCS( value['grid_north_pole_latitude'] , value['grid_north_pole_longitude'] ,
+                                                 value['north_pole_grid_longitude'] , decode_coord_system( value['ellipsoid'] ) )
+    return iris.coord_systems.GeogCS( semi_major_axis = value['semi_major_axis'] , semi_minor_axis = value['semi_minor_axis'] ,
+                                      longitude_of_prime_meridian = value['longitude_of_prime_meridian'] )
+
+# ----------------------------------------------------------------------------------------------------
+
+def encode_cube( cube , save_array ):
+    """
+    Describes a cube for JSON: its data, names, units, attributes, cell methods and coordinates.
+    """
+    if len( cube.aux_factories ) > 0:
+        raise ValueError( 'Cubes with derived coordinates can not be passed through the data service' )
+
+    dim_coords = cube.coords( dim_coords = True )
+    coords = []
+    for coord in cube.coords():
+        coords.append( { 'dim_coord' : any( coord is dim_coord for dim_coord in dim_coords ) ,
+                         'dims' : list( cube.coord_dims( coord ) ) ,
+                         'points' : encode_array( coord.points , save_array ) ,
+                         'bounds' : encode_array( coord.bounds , save_array ) if coord.has_bounds() else None ,
+                         'standard_name' : coord.standard_name , 'long_name' : coord.long_name , 'var_name' : coord.var_name ,
+                         'units' : [ str( coord.units ) , coord.units.calendar ] ,
+                         'attributes' : dict( ( name , encode_value( value ) ) for name , value in coord.attributes.iteritems() ) ,
+                         'coord_system' : encode_coord_system( coord.coord_system ) ,
+                         'circular' : getattr( coord , 'circular' , False ) } )
+
+    return { 'data' : encode_array( cube.data , save_array ) ,
+             'standard_name' : cube.standard_name , 'long_name' : cube.long_name , 'var_name' : cube.var_name ,
+             'units' : [ str( cube.units ) , cube.units.calendar ] ,
+             'attributes' : dict( ( name , encode_value( value ) ) for name , value in cube.attributes.iteritems() ) ,
+             'cell_methods' : [ [ method.method , list( method.coord_names ) , list( method.intervals ) , list( method.comments ) ]
+                                for method in cube.cell_methods ] ,
+             'coords' : coords }
+
+# ----------------------------------------------------------------------------------------------------
+
+def decode_cube( value , load_array ):
+    """
+    Rebuilds a cube described by encode_cube().
+    """
+    dim_coords = [] ; aux_coords = []
+    for coord_value in value['coords']:
+        arguments = { 'standard_name' : decode_value( coord_value['standard_name'] ) ,
+                      'long_name' : decode_value( coord_value['long_name'] ) ,
+                      'var_name' : decode_value( coord_value['var_name'] ) ,
+                      'units' : Unit( str( coord_value['units'][0] ) , calendar = decode_value( coord_value['units'][1] ) ) ,
+                      'bounds' : decode_array( coord_value['bounds'] , load_array ) if coord_value['bounds'] != None else None ,
+                      'attributes' : dict( ( str( name ) , decode_value( item ) ) for name , item in coord_value['attributes'].iteritems() ) ,
+                      'coord_system' : decode_coord_system( coord_value['coord_system'] ) }
+        points = decode_array( coord_value['points'] , load_array )
+        if coord_value['dim_coord']:
+            dim_coords.append( ( iris.coords.DimCoord( points , circular = coord_value['circular'] , **arguments ) , coord_value['dims'][0] ) )
+        else:
+            aux_coords.append( ( iris.coords.AuxCoord( points , **arguments ) , tuple( coord_value['dims'] ) ) )
+
+    cell_methods = tuple( iris.coords.CellMethod( decode_value( method ) , coords = decode_value( names ) ,
+                                                  intervals = decode_value( intervals ) , comments = decode_value( comments ) )
+                          for method , names , intervals , comments in value['cell_methods'] )
+
+    return iris.cube.Cube( decode_array( value['data'] , load_array ) ,
+                           standard_name = decode_value( value['standard_name'] ) ,
+                           long_name = decode_value( value['long_name'] ) ,
+                           var_name = decode_value( value['var_name'] ) ,
+                           units = Unit( str( value['units'][0] ) , calendar = decode_value( value['units'][1] ) ) ,
+                           attributes = dict( ( str( name ) , decode_value( item ) ) for name , item in value['attributes'].iteritems() ) ,
+                           cell_methods = cell_methods ,
+                           dim_coords_and_dims = dim_coords , aux_coords_and_dims = aux_coords )
+
+# ----------------------------------------------------------------------------------------------------
+
+def dumps_shared( cubes , spool_dir ):
+    """
+    Describes a list of cubes as JSON, writing every large numpy array to its own .npy file in the spool
+    directory instead of into the JSON.
+
+    Parameters
+    ----------
+    cubes : list of iris cubes
+        The cubes to pass.
+
+    spool_dir : string
+        Private (or group) directory shared with the service, usually in /dev/shm.
+
+    Returns
+    -------
+    payload : string
+        The JSON, holding only the names of the array files.
+
+    files : list of strings
+        The names of the array files written, the caller is responsible for them.
+    """
+    files = []
+
+    def save_array( array ):
+        name = uuid.uuid4().hex + '.npy'
+        np.save( os.path.join( spool_dir , name ) , np.ascontiguousarray( array ) )
+        files.append( name )
+        os.chmod( os.path.join( spool_dir , name ) , 0640 ) # Readable by the group of a shared spool, whatever the umask
+        return name
+
+    try:
+        payload = json.dumps( [ encode_cube( cube , save_array ) for cube in cubes ] )
+    except Exception:
+        remove_files( spool_dir , files )
+        raise
+
+    return payload , files
+
+# ----------------------------------------------------------------------------------------------------
+
+def loads_shared( payload , spool_dir ):
+    """
+    Rebuilds the cubes described by dumps_shared(), memory-mapping the array files copy-on-write so no
+    data is copied until (and unless) it is modified. Only .npy files in the spool are read, and never
+    with pickles allowed.
+    """
+    def load_array( name ):
+        return np.load( os.path.join( spool_dir , os.path.basename( name ) ) , mmap_mode = 'c' , allow_pickle = False )
+
+    return [ decode_cube( value , load_array ) for value in json.loads( payload ) ]
+
+# ----------------------------------------------------------------------------------------------------
+
+def remove_files( spool_dir , files ):
+    """
+    Removes spool files, ignoring any already removed. Clients which have mapped a file keep their pages.
+    """
+    for name in files:
+        try:
+            os.remove( os.path.join( spool_dir , os.path.basename( name ) ) )
+        except OSError:
+            pass
+
+# ----------------------------------------------------------------------------------------------------
+# The service ----------------------------------------------------------------------------------------
+
+class DataServer( object ):
+    """
+    Serves cached cubes to DataServiceClient connections, one short request per connection.
+
+    Parameters
+    ----------
+    address : string
+        A Unix socket path, or 'host:port' (use 'localhost:<port>') for a TCP socket.
+        Default setting: address = None, the socket in /tmp/cimt-<uid> (or /tmp/cimt-group-<gid>).
+
+    budget : int
+        Memory budget in bytes for the array files in the spool, least recently used entries are evicted
+        beyond it.
+
+    spool_dir : string
+        Directory for the array files, should be in shared memory (e.g. /dev/shm).
+        Default setting: spool_dir = None, /dev/shm/cimt-<uid> (or /dev/shm/cimt-group-<gid>).
+
+    key_file : string
+        File holding the secret clients must present, created if it doesn't exist.
+        Default setting: key_file = None, ~/.cimt_data_service_key (or /tmp/cimt-group-<gid>/data_service.key).
+
+    group : string
+        Name of the Unix group whose members can use the service.
+        Default setting: group = None (only the user who started it).
+    """
+    def __init__( self , address = None , budget = default_budget * 1024 ** 2 , spool_dir = None , key_file = None , group = None ):
+        self.group = group
+        self.address = parse_address( address or default_address( group ) )
+        self.budget = budget
+        self.spool_dir = spool_dir or default_spool_dir( group )
+
+        # The runtime directory is created before the key, which a group service keeps there
+        if isinstance( self.address , str ):
+            private_dir( os.path.dirname( self.address ) , create = True , group = group )
+        if group != None and key_file == None:
+            private_dir( runtime_dir( group ) , create = True , group = group )
+        self.authkey = read_authkey( key_file , create = True , group = group )
+        self.entries = OrderedDict() # key : ( payload , files , nbytes ), oldest first
+        self.used = 0
+        self.hits = 0 ; self.misses = 0
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def serve_forever( self ):
+        """
+        Runs the service until a client sends 'stop', the spool is removed on the way out.
+        """
+        if isinstance( self.address , str ) and os.path.exists( self.address ): # Left behind by a previous service
+            os.remove( self.address )
+        private_dir( self.spool_dir , create = True , group = self.group , group_write = True )
+
+        listener = Listener( self.address , authkey = self.authkey )
+        if isinstance( self.address , str ) and self.group != None: # The members of the group connect to the socket
+            os.chmod( self.address , 0660 )
+        print 'CIMTool data service listening on ' + str( self.address ) + ', spool: ' + self.spool_dir
+
+        running = True
+        try:
+            while running:
+                try:
+                    connection = listener.accept()
+                except Exception as error: # e.g. a client with the wrong key
+                    print 'Refused connection: ' + str( error )
+                    continue
+                try:
+                    running = self.handle( connection )
+                except ( EOFError , IOError , ValueError , KeyError , TypeError , IndexError ):
+                    pass # Client went away, or sent a malformed request
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            shutil.rmtree( self.spool_dir , ignore_errors = True )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def handle( self , connection ):
+        """
+        Handles one request, returns False if the service should stop.
+        """
+        request = recv_message( connection )
+        command = request[0]
+
+        if command == 'get':
+            key = request[1]
+            if key in self.entries:
+                self.entries[key] = self.entries.pop( key ) # Most recently used goes to the end
+                self.hits += 1
+                send_message( connection , [ 'hit' , self.entries[key][0] ] )
+            else:
+                self.misses += 1
+                send_message( connection , [ 'miss' , None ] )
+
+        elif command == 'put':
+            key , payload , files = request[1:]
+            self.put( key , payload , files )
+            send_message( connection , [ 'ok' , None ] )
+
+        elif command == 'spool':
+            send_message( connection , [ 'ok' , self.spool_dir ] )
+
+        elif command == 'stats':
+            send_message( connection , [ 'ok' , { 'entries' : len( self.entries ) , 'used' : self.used , 'budget' : self.budget ,
+                                                  'hits' : self.hits , 'misses' : self.misses } ] )
+
+        elif command == 'stop':
+            send_message( connection , [ 'ok' , None ] )
+            return False
+
+        else:
+            send_message( connection , [ 'error' , 'Unknown command: ' + str( command ) ] )
+
+        return True
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def put( self , key , payload , files ):
+        """
+        Takes ownership of the array files of an entry and evicts least recently used entries beyond the budget.
+        """
+        files = [ os.path.basename( name ) for name in files ] # Only files in the spool
+        nbytes = sum( os.path.getsize( os.path.join( self.spool_dir , name ) ) for name in files
+                      if os.path.exists( os.path.join( self.spool_dir , name ) ) )
+
+        if key in self.entries:
+            self.evict( key )
+
+        self.entries[key] = ( payload , files , nbytes )
+        self.used += nbytes
+
+        while self.used > self.budget and len( self.entries ) > 0:
+            self.evict( next( iter( self.entries ) ) )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def evict( self , key ):
+        """
+        Removes an entry and its array files.
+        """
+        payload , files , nbytes = self.entries.pop( key )
+        self.used -= nbytes
+        remove_files( self.spool_dir , files )
+
+# ----------------------------------------------------------------------------------------------------
+# The client used by ImpactMetric --------------------------------------------------------------------
+
+class DataServiceClient( object ):
+    """
+    Fetches and stores cubes in a running DataServer of the same user (or of a group the user is in).
+
+    Example
+    -------
+    client = DataServiceClient.connect()
+    if client != None:
+        cubes = client.fetch( key )
+    """
+    def __init__( self , address = None , key_file = None , group = None ):
+        address = address or default_address( group )
+        if not address.startswith( '/' ) and ':' in address:
+            self.address = parse_address( address )
+        else: # Only a socket in a private directory, not one another user could have put there
+            private_dir( os.path.dirname( address ) , group = group )
+            self.address = address
+        self.authkey = read_authkey( key_file , group = group )
+        self.spool_dir = private_dir( self.request( 'spool' ) , group = group , group_write = True )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    @classmethod
+    def connect( cls , address = None , key_file = None , group = None ):
+        """
+        Returns a client, or None if there is no service it can use at the address.
+        """
+        try:
+            return cls( address , key_file , group )
+        except ( IOError , EOFError , AuthenticationError , DataServiceError ) as error: # socket.error is an IOError
+            where = address or ( 'the service of group ' + group if group != None else default_address() )
+            print 'No CIMTool data service at ' + str( where ) + ' (' + str( error ) + '), loading files directly'
+            return None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def request( self , *request ):
+        """
+        Sends one request on a new connection and returns the reply value.
+        """
+        connection = Client( self.address , authkey = self.authkey )
+        try:
+            send_message( connection , list( request ) )
+            status , value = recv_message( connection )
+        finally:
+            connection.close()
+
+        if status == 'error':
+            raise StandardError( value )
+        if status == 'miss':
+            return None
+        return value
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def fetch( self , key ):
+        """
+        Returns the cached cubes for a key, or None if the service doesn't have them (or has gone away, or
+        the entry can't be read).
+        """
+        try:
+            payload = self.request( 'get' , json.dumps( key ) )
+            if payload == None:
+                return None
+            return loads_shared( payload , self.spool_dir )
+        except ( IOError , EOFError , ValueError , KeyError , TypeError , IndexError , AuthenticationError ): # e.g. evicted while being mapped
+            return None
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def store( self , key , cubes ):
+        """
+        Stores a list of cubes for a key, failures are ignored as the cubes can always be reloaded.
+        """
+        files = []
+        try:
+            payload , files = dumps_shared( cubes , self.spool_dir )
+            self.request( 'put' , json.dumps( key ) , payload , files )
+        except ( IOError , EOFError , OSError , ValueError , AuthenticationError ): # ValueError: cubes which can't be passed
+            remove_files( self.spool_dir , files )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def stats( self ):
+        """
+        Returns a dictionary of the number of entries, bytes used, budget, hits and misses of the service.
+        """
+        return self.request( 'stats' )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def stop( self ):
+        """
+        Asks the service to stop.
+        """
+        return self.request( 'stop' )
+
+# ----------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'CIMTool warm-data service' )
+    parser.add_argument( '--address' , default = None , help = 'Unix socket path or host:port (default: /tmp/cimt-<uid>/data_service.sock)' )
+    parser.add_argument( '--budget' , type = float , default = default_budget , help = 'Memory budget in MB (default: %(default)s)' )
+    parser.add_argument( '--spool-dir' , default = None , help = 'Private shared memory directory for the data (default: /dev/shm/cimt-<uid>)' )
+    parser.add_argument( '--key-file' , default = None , help = 'File of the secret clients must present (default: ' + default_key_file + ')' )
+    parser.add_argument( '--group' , default = None , help = 'Unix group whose members can use the service (default: only you)' )
+    args = parser.parse_args()
+
+    DataServer( args.address , int( args.budget * 1024 ** 2 ) , args.spool_dir , args.key_file , args.group ).serve_forever()
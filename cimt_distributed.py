@@ -0,0 +1,358 @@
+'''
+cimt_distributed.py
+Climate Impact Metrics Tool 'distributed' file
+
+Runs the tool across several processes, on one or many nodes, through a task queue on a shared filesystem.
+The (period, jobset, member) tasks of the run plan (see "cimt_run_plan.py") are written to an SQLite
+database in the queue directory. Any number of workers, started on any node which can see the queue
+directory, claim the tasks one at a time, load their member and save its temporal mean. A final reduce
+step assembles the ensemble means, anomalies and outputs exactly as cimt_main.py does.
+
+Usage (from the directory holding 'cimt_interface.ini'):
+    python cimt_main.py --distributed submit --queue /shared/dir/queue
+    python cimt_main.py --distributed worker --queue /shared/dir/queue     (on each node, as many as wanted)
+    python cimt_main.py --distributed reduce --queue /shared/dir/queue
+    python cimt_main.py --distributed retry --queue /shared/dir/queue      (requeues failed tasks)
+
+or on a single machine, with several worker processes:
+    python cimt_main.py --distributed local --queue /tmp/queue --workers 4
+
+Trend analysis ([trends] trend_analysis = on) is not run by the queue, a distributed run refuses to start
+with it on. Run the trends with cimt_main.py on its own.
+
+NB- SQLite relies on the file locking of the shared filesystem, check that it is supported (e.g. NFS with
+lockd, Lustre mounted with flock) before using a queue from several nodes.
+'''
+
+import os
+import time
+import socket
+import sqlite3
+import traceback
+import multiprocessing
+import numpy as np
+import iris
+
+import cimt_settings
+import cimt_run_plan
+import cimt_time_series
+
+interface_file = 'cimt_interface.ini'
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for the queue database -------------------------------------------------------------------
+
+def connect( queue_dir ):
+    """
+    Opens the queue database, transactions are started explicitly.
+    """
+    return sqlite3.connect( os.path.join( queue_dir , 'queue.sqlite' ) , timeout = 120 , isolation_level = None )
+
+# ----------------------------------------------------------------------------------------------------
+
+def result_path( queue_dir , task_id , extension ):
+    """
+    Returns the path of a result file of a task.
+    """
+    return os.path.join( queue_dir , 'results' , 'task_' + str( task_id ) + extension )
+
+# ----------------------------------------------------------------------------------------------------
+
+def read_tasks( queue_dir ):
+    """
+    Returns every task of the queue as a list of dictionaries, in the order of the run plan.
+    """
+    connection = connect( queue_dir )
+    connection.row_factory = sqlite3.Row
+    try:
+        return [ dict( row ) for row in connection.execute( 'SELECT * FROM tasks ORDER BY id' ) ]
+    finally:
+        connection.close()
+
+# ----------------------------------------------------------------------------------------------------
+
+def check_interface( connection ):
+    """
+    Checks that the interface file in the working directory is the one the queue was submitted with, so
+    that every worker runs with the same settings.
+    """
+    submitted = connection.execute( "SELECT value FROM settings WHERE name = 'interface'" ).fetchone()[0]
+    with open( interface_file ) as interface:
+        if interface.read() != submitted:
+            raise StandardError( "'" + interface_file + "' has changed since the queue was submitted, run from the same settings" )
+
+# ----------------------------------------------------------------------------------------------------
+# The steps of a distributed run ---------------------------------------------------------------------
+
+def check_no_trends():
+    """
+    Raises an error if trend analysis is on, as the queue only has tasks for the temporal means and would
+    otherwise finish without any trend maps.
+    """
+    if cimt_settings.trend_analysis:
+        raise StandardError("Trend analysis is not available in a distributed run, set trend_analysis = off in [trends] " +
+                            "or run cimt_main.py without --distributed")
+
+# ----------------------------------------------------------------------------------------------------
+
+def submit( metric_class , queue_dir ):
+    """
+    Plans the run and writes one task per (period, jobset, member) to a new queue. Fails, as the --plan
+    mode does, on missing files, years or stash codes before anything is queued.
+
+    Parameters
+    ----------
+    metric_class : class
+        The metric, e.g. cimt_metrics.NPP
+
+    queue_dir : string
+        Directory for the queue, on a filesystem shared by every worker. Must not already hold a queue.
+    """
+    check_no_trends()
+    plan = cimt_run_plan.RunPlan( metric_class )
+    plan.check()
+
+    if os.path.exists( os.path.join( queue_dir , 'queue.sqlite' ) ):
+        raise StandardError( "A queue already exists in " + queue_dir + ", reduce it or choose another directory" )
+    if not os.path.isdir( os.path.join( queue_dir , 'results' ) ):
+        os.makedirs( os.path.join( queue_dir , 'results' ) )
+
+    connection = connect( queue_dir )
+    try:
+        connection.execute( 'BEGIN IMMEDIATE' )
+        connection.execute( 'CREATE TABLE settings ( name TEXT PRIMARY KEY , value TEXT )' )
+        connection.execute( '''CREATE TABLE tasks ( id INTEGER PRIMARY KEY , period TEXT , jobset TEXT , base_run INTEGER ,
+                                                    instance INTEGER , job TEXT , runid TEXT , status TEXT DEFAULT 'pending' ,
+                                                    worker TEXT , attempts INTEGER DEFAULT 0 , claimed_at REAL , finished_at REAL ,
+                                                    error TEXT )''' )
+        with open( interface_file ) as interface:
+            connection.execute( 'INSERT INTO settings VALUES ( ? , ? )' , ( 'interface' , interface.read() ) )
+        connection.execute( 'INSERT INTO settings VALUES ( ? , ? )' , ( 'impact_metric' , metric_class.__name__ ) )
+
+        for task in plan.tasks:
+            connection.execute( 'INSERT INTO tasks ( period , jobset , base_run , instance , job , runid ) VALUES ( ? , ? , ? , ? , ? , ? )' ,
+                                ( task['period'] , task['jobset'] , int( task['base_run'] ) , task['instance'] , task['job'] , task['runid'] ) )
+        connection.execute( 'COMMIT' )
+    except Exception:
+        connection.execute( 'ROLLBACK' )
+        raise
+    finally:
+        connection.close()
+
+    print 'Submitted ' + str( len( plan.tasks ) ) + ' tasks to ' + queue_dir + ' , suggested workers: ' + str( plan.suggested_workers() )
+
+    return plan
+
+# ----------------------------------------------------------------------------------------------------
+
+def claim( connection , worker_name , reclaim_after = None ):
+    """
+    Claims the next pending task in a single write transaction, so no two workers can claim the same task.
+    Tasks claimed more than reclaim_after seconds ago and not finished (e.g. their worker was killed)
+    are claimed again.
+
+    Returns
+    -------
+    dictionary
+        The task, or None if there is nothing left to claim.
+    """
+    connection.execute( 'BEGIN IMMEDIATE' )
+    try:
+        query = "SELECT * FROM tasks WHERE status = 'pending'"
+        parameters = ()
+        if reclaim_after != None:
+            query += " OR ( status = 'running' AND claimed_at < ? )"
+            parameters = ( time.time() - reclaim_after , )
+        row = connection.execute( query + ' ORDER BY id LIMIT 1' , parameters ).fetchone()
+
+        if row != None:
+            connection.execute( "UPDATE tasks SET status = 'running' , worker = ? , claimed_at = ? , attempts = attempts + 1 WHERE id = ?" ,
+                                ( worker_name , time.time() , row['id'] ) )
+        connection.execute( 'COMMIT' )
+    except Exception:
+        connection.execute( 'ROLLBACK' )
+        raise
+
+    return dict( row ) if row != None else None
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_task( metric_class , queue_dir , task ):
+    """
+    Loads the member of one task and saves its temporal mean (and its area-mean series if the time series
+    product is chosen) to the results directory of the queue.
+    """
+    metric = metric_class()
+    metric.load_modify_cubes( base_run = bool( task['base_run'] ) , period = task['period'] , instance = task['instance'] , jobs = [ task['job'] ] )
+
+    if cimt_settings.time_series != 'off':
+        area_means = metric.area_mean_series()
+        with open( result_path( queue_dir , task['id'] , '.series.tmp' ) , 'wb' ) as series_file: # Plain arrays, no pickles
+            np.savez( series_file , dates = area_means['dates'][0] , series = area_means['series'][0] )
+        os.rename( result_path( queue_dir , task['id'] , '.series.tmp' ) , result_path( queue_dir , task['id'] , '.series.npz' ) )
+
+    time_mean = metric.temporal_mean()[0]
+
+    # Written under a temporary name and renamed so a killed worker never leaves a partial result
+    iris.fileformats.netcdf.save( time_mean , result_path( queue_dir , task['id'] , '.tmp.nc' ) )
+    os.rename( result_path( queue_dir , task['id'] , '.tmp.nc' ) , result_path( queue_dir , task['id'] , '.nc' ) )
+
+# ----------------------------------------------------------------------------------------------------
+
+def worker( metric_class , queue_dir , reclaim_after = None ):
+    """
+    Claims and runs tasks until the queue has none left. A failed task is marked as failed with its
+    traceback and the worker moves on to the next one.
+
+    Returns
+    -------
+    int
+        The number of tasks this worker completed.
+    """
+    worker_name = socket.gethostname() + ':' + str( os.getpid() )
+    connection = connect( queue_dir )
+    connection.row_factory = sqlite3.Row
+    check_interface( connection )
+
+    completed = 0
+    try:
+        while True:
+            task = claim( connection , worker_name , reclaim_after )
+            if task == None:
+                break
+
+            print worker_name + ' running task ' + str( task['id'] ) + ': ' + task['period'] + ' ' + task['jobset'] + ' ' + task['runid']
+            try:
+                run_task( metric_class , queue_dir , task )
+                connection.execute( "UPDATE tasks SET status = 'done' , finished_at = ? , error = NULL WHERE id = ?" , ( time.time() , task['id'] ) )
+                completed += 1
+            except Exception:
+                connection.execute( "UPDATE tasks SET status = 'failed' , finished_at = ? , error = ? WHERE id = ?" ,
+                                    ( time.time() , traceback.format_exc() , task['id'] ) )
+                print worker_name + ' task ' + str( task['id'] ) + ' failed:\n' + traceback.format_exc()
+    finally:
+        connection.close()
+
+    return completed
+
+# ----------------------------------------------------------------------------------------------------
+
+def retry_failed( queue_dir ):
+    """
+    Puts the failed tasks of a queue back to pending (e.g. after fixing a missing file), for the workers to claim again.
+    """
+    connection = connect( queue_dir )
+    try:
+        count = connection.execute( "UPDATE tasks SET status = 'pending' , worker = NULL , error = NULL WHERE status = 'failed'" ).rowcount
+    finally:
+        connection.close()
+
+    print 'Requeued ' + str( count ) + ' failed task(s) in ' + queue_dir
+
+    return count
+
+# ----------------------------------------------------------------------------------------------------
+
+def reduce_queue( metric_class , queue_dir ):
+    """
+    Assembles the results of a finished queue: the ensemble means, anomalies, outputs and time series,
+    as cimt_main.py does when run in one process.
+    """
+    connection = connect( queue_dir )
+    try:
+        check_interface( connection ) # The outputs are assembled with the settings the members were computed with
+    finally:
+        connection.close()
+
+    tasks = read_tasks( queue_dir )
+
+    unfinished = [ task for task in tasks if task['status'] != 'done' ]
+    if len( unfinished ) > 0:
+        raise StandardError( str( len( unfinished ) ) + " task(s) not done yet: " +
+                             ', '.join( str( task['id'] ) + ' (' + task['status'] + ')' for task in unfinished ) +
+                             "\nFailed tasks can be requeued with '--distributed retry' once fixed" )
+
+    periods = []
+    for task in tasks:
+        if task['period'] not in periods:
+            periods.append( task['period'] )
+
+    for period in periods:
+        AreaMeans = []
+        BaseMetric = restore_metric( metric_class , queue_dir , [ task for task in tasks if task['period'] == period and task['base_run'] ] ,
+                                     True , period , None , AreaMeans )
+        BaseMetric.ensemble_mean()
+
+        FutureMetrics = []
+        if cimt_settings.comparison_type != 'base_only':
+            for instance in range( cimt_settings.number_of_future_jobsets ):
+                future_tasks = [ task for task in tasks if task['period'] == period and not task['base_run'] and task['instance'] == instance ]
+                FutureMetric = restore_metric( metric_class , queue_dir , future_tasks , False , period , instance , AreaMeans )
+                FutureMetric.ensemble_mean()
+                FutureMetric.subtract_cubes( BaseMetric )
+                FutureMetrics.append( FutureMetric )
+
+        # The maps of every jobset of the period are drawn with the same colour scales
+        ColourScales = metric_class.colour_scales( [ BaseMetric ] + FutureMetrics )
+        if cimt_settings.comparison_type == 'base_only':
+            BaseMetric.save_outputs( scales = ColourScales )
+        for FutureMetric in FutureMetrics:
+            FutureMetric.save_outputs( BaseMetric , ColourScales )
+
+        if cimt_settings.time_series != 'off':
+            cimt_time_series.save_time_series( cimt_settings.SAVEDIR , cimt_settings.impact_metric + '_Time_Series_' + BaseMetric.period ,
+                                               AreaMeans , BaseMetric.units , cimt_settings.time_series ,
+                                               cimt_settings.time_series_window , cimt_settings.time_series_window_type )
+
+# ----------------------------------------------------------------------------------------------------
+
+def restore_metric( metric_class , queue_dir , tasks , base_run , period , instance , area_means ):
+    """
+    Creates a metric for one jobset from the saved results of its tasks, appending its time series (if
+    any) to area_means.
+    """
+    metric = metric_class()
+    metric.set_jobset( base_run , period , instance )
+    maps = [ iris.load_cube( result_path( queue_dir , task['id'] , '.nc' ) ) for task in tasks ]
+    metric.restore_maps( maps , [ task['runid'] for task in tasks ] )
+
+    if cimt_settings.time_series != 'off':
+        dates = [] ; series = []
+        for task in tasks:
+            # Anyone who can write to the queue directory can write these files, so they are never unpickled
+            with np.load( result_path( queue_dir , task['id'] , '.series.npz' ) , allow_pickle = False ) as series_file:
+                dates.append( series_file['dates'] ) ; series.append( series_file['series'] )
+        area_means.append( { 'description' : metric.job_description , 'runids' : list( metric.list_jobnames ) ,
+                             'dates' : dates , 'series' : series } )
+
+    return metric
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_local( metric_class , queue_dir , workers = None ):
+    """
+    Runs a whole distributed run on this machine: submits the queue (unless it already exists), starts
+    several worker processes, waits for them and reduces. Useful for testing, and for using every core
+    of a single node.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes.
+        Default setting: workers = None (the suggested number from the run plan).
+    """
+    check_no_trends()
+    if not os.path.exists( os.path.join( queue_dir , 'queue.sqlite' ) ):
+        plan = submit( metric_class , queue_dir )
+        if workers == None:
+            workers = plan.suggested_workers()
+    if workers == None:
+        workers = multiprocessing.cpu_count()
+
+    processes = [ multiprocessing.Process( target = worker , args = ( metric_class , queue_dir ) ) for number in range( workers ) ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    reduce_queue( metric_class , queue_dir )
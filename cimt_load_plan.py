@@ -0,0 +1,175 @@
+'''
+cimt_load_plan.py
+Climate Impact Metrics Tool 'load plan' file
+'''
+
+import iris
+from iris import analysis
+import iris.analysis.maths
+
+# ----------------------------------------------------------------------------------------------------
+# Reductions which can be applied over a set of model levels -----------------------------------------
+
+level_reductions = { 'sum' : iris.analysis.SUM ,
+                     'mean' : iris.analysis.MEAN
+                     }
+
+# ----------------------------------------------------------------------------------------------------
+# Declarative description of a metric ----------------------------------------------------------------
+
+class MetricDefinition( object ):
+    """
+    A declarative description of what a metric reads from the UM output and how it is combined, used
+    instead of hand-writing load_cube() for a metric. The definition is compiled into a LoadPlan which
+    loads every component in a single constrained iris.load call.
+    ----------------------------------------------------------------------------------------------------
+
+    Attributes
+    ----------
+    full_name : string
+        Use capitalized words separated by an underscore.
+
+    stash : string OR a list of strings
+        Use the UM stash number, following this format: 'm01s08i235'. If more than one stash is given
+        the components are summed, e.g. surface and sub-surface runoff.
+
+    units : string
+        Defines the desirable units.
+
+    unit_factor : int / float
+        A multiplication factor to convert the model output units into the desired units specified above.
+        Default setting: unit_factor = 1.
+
+    level_coord : string
+        Name of the level coordinate to select on, e.g. 'soil_model_level_number'.
+        Default setting: level_coord = None (no level selection).
+
+    levels : list of ints
+        The levels of level_coord to keep, e.g. [ 1 , 2 , 3 ] for the top metre of soil.
+        Default setting: levels = None.
+
+    level_reduction : string
+        How the selected levels are combined, one of the keys of level_reductions ('sum' or 'mean').
+        Default setting: level_reduction = 'sum'.
+
+    Example
+    -------
+    definition = MetricDefinition( 'Soil_Moisture_1m' , 'm01s08i223' , 'm^3 m^-3' , 1 ,
+                                   level_coord = 'soil_model_level_number' , levels = [ 1 , 2 , 3 ] )
+    """
+    def __init__( self , full_name , stash , units , unit_factor = 1 , level_coord = None , levels = None , level_reduction = 'sum' ):
+        self.full_name = full_name
+        self.stash = stash
+        self.units = units
+        self.unit_factor = unit_factor
+        self.level_coord = level_coord
+        self.levels = levels
+        self.level_reduction = level_reduction
+
+        if ( level_coord == None ) != ( levels == None ):
+            raise StandardError( "Both level_coord and levels must be given to select levels for " + full_name )
+
+        if level_reduction not in level_reductions:
+            raise StandardError( "Choose a level_reduction from: " + ', '.join( sorted( level_reductions.keys() ) ) )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    @property
+    def stash_codes( self ):
+        """
+        The stash number(s) of the definition, always as a list of strings.
+        """
+        if isinstance( self.stash , basestring ):
+            return [ self.stash ]
+        return list( self.stash )
+
+# ----------------------------------------------------------------------------------------------------
+# Planner turning a definition into a single constrained load ----------------------------------------
+
+class LoadPlan( object ):
+    """
+    The compiled form of a MetricDefinition. All stash codes and level selections are combined into one
+    iris constraint so the files are read once, the selected levels are reduced with a single collapse
+    over the level axis and the stash components are then summed.
+
+    Example
+    -------
+    plan = LoadPlan( definition )
+    cube = plan.load( list_of_pp_files )
+    """
+    def __init__( self , definition ):
+        self.definition = definition
+        self.stash_codes = definition.stash_codes
+
+        stash_codes = set( self.stash_codes )
+        self.constraint = iris.AttributeConstraint( STASH = lambda stash: str( stash ) in stash_codes )
+
+        if definition.level_coord != None:
+            levels = list( definition.levels ) # A list, not a set, as iris cells compare equal to ints but don't hash like them
+            self.constraint = self.constraint & iris.Constraint( **{ definition.level_coord : lambda cell: cell in levels } )
+            self.aggregator = level_reductions[ definition.level_reduction ]
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def describe( self ):
+        """
+        Returns a short, human readable description of the plan.
+        """
+        description = 'Load stash ' + ', '.join( self.stash_codes )
+        if self.definition.level_coord != None:
+            description += ' on ' + self.definition.level_coord + ' ' + str( self.definition.levels )
+            description += ', ' + self.definition.level_reduction + ' over levels'
+        if len( self.stash_codes ) > 1:
+            description += ', sum over stash'
+
+        return description
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def load( self , filenames ):
+        """
+        Loads the metric from a list of files following the plan.
+
+        Parameters
+        ----------
+        filenames : list of strings
+            Full path of each file to load, e.g. the files of one job from get_apy_files()
+
+        Returns
+        -------
+        iris cube
+            A single cube with the levels reduced and the stash components summed.
+        """
+        cubes = iris.load( filenames , self.constraint )
+
+        components = []
+        for stash in self.stash_codes:
+            matching = [ cube for cube in cubes if str( cube.attributes.get( 'STASH' ) ) == stash ]
+            if len( matching ) != 1:
+                raise StandardError( "Expected one cube for stash " + stash + " but found " + str( len( matching ) ) + ", check the files requested" )
+            components.append( self.__reduce_levels( matching[0] ) )
+
+        cube = components[0]
+        for component in components[1:]: # Accumulate in place rather than allocating a new cube per component
+            iris.analysis.maths.add( cube , component , in_place = True )
+
+        return cube
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within load()
+    def __reduce_levels( self , cube ):
+        """
+        Collapses the selected levels of a cube in one pass over the level axis.
+        """
+        if self.definition.level_coord == None:
+            return cube
+
+        level_coord = cube.coord( self.definition.level_coord )
+        if len( level_coord.points ) != len( self.definition.levels ):
+            raise StandardError( "Requested " + self.definition.level_coord + " " + str( self.definition.levels ) + " but only found " + str( list( level_coord.points ) ) )
+
+        if len( level_coord.points ) == 1: # A single level is loaded as a scalar coordinate, nothing to reduce
+            return cube
+
+        return cube.collapsed( self.definition.level_coord , self.aggregator )
@@ -3,23 +3,94 @@ cimt_main.py
 Climate Impact Metrics Tool 'main' file
 '''
 
+import argparse
+
 import cimt_settings
 import cimt_metrics
+import cimt_run_plan
+import cimt_time_series
+import cimt_distributed
+
+parser = argparse.ArgumentParser( description = 'Climate Impact Metrics Tool, configured by cimt_interface.ini' )
+parser.add_argument( '--plan' , action = 'store_true' ,
+                     help = 'Print the work, file counts, bytes and estimated memory of the run without loading any data' )
+parser.add_argument( '--distributed' , choices = [ 'submit' , 'worker' , 'reduce' , 'retry' , 'local' ] ,
+                     help = 'Run through a task queue on a shared filesystem, see cimt_distributed.py' )
+parser.add_argument( '--queue' , default = cimt_settings.SAVEDIR + '/cimt_queue' ,
+                     help = 'Queue directory for --distributed (default: %(default)s)' )
+parser.add_argument( '--workers' , type = int , default = None ,
+                     help = 'Worker processes for --distributed local (default: suggested by the run plan)' )
+parser.add_argument( '--reclaim-after' , type = float , default = None ,
+                     help = 'Seconds after which a worker claims again a task left running, e.g. by a killed worker' )
+args = parser.parse_args()
 
 ImpactMetric = getattr( cimt_metrics , cimt_settings.impact_metric )
 
-for period_index in cimt_settings.period_list:
-    BaseMetric = ImpactMetric()
-    BaseMetric.load_modify_cubes( base_run = True , period = period_index  )
-    BaseMetric.temporal_mean()
-    BaseMetric.ensemble_mean()
-    if cimt_settings.comparison_type == 'base_only':  
-        BaseMetric.save_outputs() # Program terminates here if base-only
-    else: 
-        for instance_index in range( cimt_settings.number_of_future_jobsets ):
-            FutureMetric = ImpactMetric()
-            FutureMetric.load_modify_cubes( base_run = False , period = period_index , instance = instance_index )
-            FutureMetric.temporal_mean()
-            FutureMetric.ensemble_mean()
-            FutureMetric.subtract_cubes( BaseMetric )
-            FutureMetric.save_outputs( BaseMetric )
\ No newline at end of file
+if args.plan: # Dry run, fails on missing files, years or stash codes
+    RunPlan = cimt_run_plan.RunPlan( ImpactMetric )
+    RunPlan.print_plan()
+    RunPlan.check()
+
+elif args.distributed == 'submit':
+    cimt_distributed.submit( ImpactMetric , args.queue )
+
+elif args.distributed == 'worker':
+    cimt_distributed.worker( ImpactMetric , args.queue , args.reclaim_after )
+
+elif args.distributed == 'reduce':
+    cimt_distributed.reduce_queue( ImpactMetric , args.queue )
+
+elif args.distributed == 'retry':
+    cimt_distributed.retry_failed( args.queue )
+
+elif args.distributed == 'local':
+    cimt_distributed.run_local( ImpactMetric , args.queue , args.workers )
+    
+else:
+    for period_index in cimt_settings.period_list:
+        AreaMeans = [] # Time series of every jobset, saved together at the end of the period
+        BaseMetric = ImpactMetric()
+        BaseMetric.load_modify_cubes( base_run = True , period = period_index  )
+        if cimt_settings.time_series != 'off':
+            AreaMeans.append( BaseMetric.area_mean_series() )
+        BaseMetric.temporal_mean()
+        BaseMetric.ensemble_mean()
+        BaseMetric.release_cubes() # Only the maps are kept until the outputs are saved
+        
+        FutureMetrics = [] # None if base-only
+        if cimt_settings.comparison_type != 'base_only':
+            for instance_index in range( cimt_settings.number_of_future_jobsets ):
+                FutureMetric = ImpactMetric()
+                FutureMetric.load_modify_cubes( base_run = False , period = period_index , instance = instance_index )
+                if cimt_settings.time_series != 'off':
+                    AreaMeans.append( FutureMetric.area_mean_series() )
+                FutureMetric.temporal_mean()
+                FutureMetric.ensemble_mean()
+                FutureMetric.subtract_cubes( BaseMetric )
+                FutureMetric.release_cubes()
+                FutureMetrics.append( FutureMetric )
+        
+        TrendMetrics = []
+        if cimt_settings.trend_analysis: # Trend maps of each jobset, the files are streamed again one year at a time
+            BaseTrends = ImpactMetric()
+            BaseTrends.trend_analysis( base_run = True , period = period_index )
+            TrendMetrics.append( BaseTrends )
+            if cimt_settings.comparison_type != 'base_only':
+                for instance_index in range( cimt_settings.number_of_future_jobsets ):
+                    FutureTrends = ImpactMetric()
+                    FutureTrends.trend_analysis( base_run = False , period = period_index , instance = instance_index )
+                    TrendMetrics.append( FutureTrends )
+        
+        # The maps (and trends) of every jobset of the period are drawn with the same colour scales
+        ColourScales = ImpactMetric.colour_scales( [ BaseMetric ] + FutureMetrics + TrendMetrics )
+        if cimt_settings.comparison_type == 'base_only':
+            BaseMetric.save_outputs( scales = ColourScales )
+        for FutureMetric in FutureMetrics:
+            FutureMetric.save_outputs( BaseMetric , ColourScales )
+        for TrendMetric in TrendMetrics:
+            TrendMetric.save_outputs( scales = ColourScales )
+        
+        if cimt_settings.time_series != 'off':
+            cimt_time_series.save_time_series( cimt_settings.SAVEDIR , cimt_settings.impact_metric + '_Time_Series_' + BaseMetric.period ,
+                                               AreaMeans , BaseMetric.units , cimt_settings.time_series ,
+                                               cimt_settings.time_series_window , cimt_settings.time_series_window_type )
\ No newline at end of file
@@ -0,0 +1,221 @@
+'''
+cimt_memory_benchmark.py
+Climate Impact Metrics Tool 'memory benchmark' file
+
+Compares the peak memory (peak RSS) of loading and reducing one jobset of the T_ROFF metric (two stash
+components) before and after the working precision / in-place changes:
+
+    previous : the earlier code, iris.load_cube per stash and sum( cubes ), cube = cube * unit_factor
+               (new cube), maps collapsed twice, ens_mean = sum( maps ) / n
+    current  : the tool's own code, ImpactMetric.load_modify_cubes() (load plan, background prefetch of
+               the next members, in-place scaling at the working precision), temporal_mean() and
+               ensemble_mean() (accumulated in place)
+
+Synthetic annual .pp files with the shapes of UM output are written to a temporary DATADIR first, laid out
+as the tool expects (DATADIR/runid/*a.py*.pp), so no model output is needed. Each path is then run in a
+fresh process so the peak RSS of one doesn't hide the other. The current path uses the settings of
+"cimt_interface.ini", except for the jobset, DATADIR and the options given here, so run it from the tool's
+directory.
+
+Usage
+-----
+python cimt_memory_benchmark.py [--grid N96] [--members 10] [--years 30] [--precision float32] [--prefetch_depth 2]
+
+Results
+-------
+No results are recorded here: the peak depends on the grid, the number of members, the prefetch settings
+and the versions of iris and numpy, so run the benchmark on the machine the tool is used on. When reading
+them, note that .pp fields are already stored as 32-bit, so the float32 working precision only saves the
+transient copy of each member made by cube * unit_factor. Prefetch holds up to prefetch_depth extra
+members while the current one is reduced (bounded by prefetch_memory_cap), which can outweigh that saving;
+--prefetch_depth 0 compares the loading and reduction alone.
+'''
+
+import os
+import sys
+import shutil
+import argparse
+import datetime
+import resource
+import tempfile
+import subprocess
+
+import numpy as np
+import iris
+from iris import analysis
+import iris.coord_categorisation as cat
+import iris.fileformats.pp
+
+import cimt_settings
+import cimt_utilities
+import cimt_metrics
+
+grids = { 'N96' : ( 145 , 192 ) ,
+          'N216' : ( 325 , 432 )
+          }
+
+benchmark_metric = cimt_metrics.T_ROFF # Two stash components, so the load plan sums them
+
+start_year = 2000
+
+# ----------------------------------------------------------------------------------------------------
+# Synthetic members ----------------------------------------------------------------------------------
+
+def runid( member ):
+    """
+    Returns the UM job name of a synthetic member.
+    """
+    return 'bm%03d' % member
+
+# ----------------------------------------------------------------------------------------------------
+
+def hours( date ):
+    """
+    Returns the time of a date in hours since 1970, the units of the time coordinate of the synthetic files.
+    """
+    return ( date - datetime.datetime( 1970 , 1 , 1 ) ).total_seconds() / 3600.0
+
+# ----------------------------------------------------------------------------------------------------
+
+def write_members( data_dir , grid , members , years ):
+    """
+    Writes one annual .pp file per member and year, holding every stash component of the benchmark metric
+    on the grid. Only the shapes and types matter, not the values.
+    """
+    n_lat , n_lon = grid
+    latitude = iris.coords.DimCoord( np.linspace( -90.0 , 90.0 , n_lat ) , standard_name = 'latitude' , units = 'degrees' ,
+                                     coord_system = iris.coord_systems.GeogCS( 6371229.0 ) )
+    longitude = iris.coords.DimCoord( np.arange( n_lon ) * 360.0 / n_lon , standard_name = 'longitude' , units = 'degrees' ,
+                                      coord_system = iris.coord_systems.GeogCS( 6371229.0 ) )
+
+    for member in range( members ):
+        os.mkdir( os.path.join( data_dir , runid( member ) ) )
+        for year in range( start_year , start_year + years ):
+            time = iris.coords.DimCoord( hours( datetime.datetime( year , 7 , 1 ) ) , standard_name = 'time' ,
+                                         units = 'hours since 1970-01-01 00:00:00' ,
+                                         bounds = [ hours( datetime.datetime( year , 1 , 1 ) ) , hours( datetime.datetime( year + 1 , 1 , 1 ) ) ] )
+
+            components = []
+            for stash in benchmark_metric.definition.stash_codes:
+                data = np.empty( grid , dtype = np.float32 )
+                data.fill( 1.0e-5 )
+                cube = iris.cube.Cube( data , long_name = 'runoff_' + stash , units = 'kg m-2 s-1' ,
+                                       attributes = { 'STASH' : iris.fileformats.pp.STASH.from_msi( stash ) } ,
+                                       dim_coords_and_dims = [ ( latitude.copy() , 0 ) , ( longitude.copy() , 1 ) ] )
+                cube.add_aux_coord( time.copy() )
+                cube.add_cell_method( iris.coords.CellMethod( 'mean' , coords = 'time' ) )
+                components.append( cube )
+
+            filename = os.path.join( data_dir , runid( member ) , runid( member ) + 'a.py' + str( year ) + '1201.pp' )
+            iris.save( components , filename )
+
+# ----------------------------------------------------------------------------------------------------
+# The two paths being compared -----------------------------------------------------------------------
+
+def previous_path( data_dir , members , years ):
+    """
+    Loads and reduces the members as ImpactMetric did before working precision, in-place scaling and prefetch.
+    """
+    metric = benchmark_metric()
+
+    cubes = []
+    for member in range( members ):
+        filenames = cimt_utilities.get_apy_files( data_dir , runid( member ) )
+        cubes_to_sum = []
+        for stash in metric.definition.stash_codes:
+            cubes_to_sum.append( iris.load_cube( filenames , iris.AttributeConstraint( STASH = stash ) ) )
+        cube = sum( cubes_to_sum )
+        cat.add_year( cube , 'time' , name = 'year' )
+        cube = cube * metric.unit_factor
+        cube = cube.extract( iris.Constraint( year = lambda cell: start_year <= cell <= start_year + years - 1 ) )
+        cubes.append( cube )
+
+    maps = [] ; cubes_to_output = []
+    for cube in cubes:
+        maps.append( cube.collapsed( 'time' , iris.analysis.MEAN ) )
+        cubes_to_output.append( cube.collapsed( 'time' , iris.analysis.MEAN ) )
+
+    ens_mean = sum( maps ) / len( maps )
+
+    return ens_mean
+
+# ----------------------------------------------------------------------------------------------------
+
+def current_path( data_dir , members , years ):
+    """
+    Loads and reduces the members with the tool's own load_modify_cubes(), temporal_mean() and ensemble_mean().
+    """
+    # The synthetic members as the base jobset, read directly rather than through the data service
+    cimt_settings.DATADIR = data_dir
+    cimt_settings.period_type = 'annual'
+    cimt_settings.data_service_mode = 'off'
+    cimt_settings.base_start = str( start_year )
+    cimt_settings.base_end = str( start_year + years - 1 )
+    cimt_settings.base_jobs_dict = dict( ( 'base_job_ens' + str( member + 1 ) , runid( member ) ) for member in range( members ) )
+
+    metric = benchmark_metric()
+    metric.load_modify_cubes( base_run = True , period = 'ann' )
+    metric.temporal_mean()
+
+    return metric.ensemble_mean()
+
+# ----------------------------------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process in MB (ru_maxrss is in kB on Linux).
+    """
+    return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / 1024.0
+
+# ----------------------------------------------------------------------------------------------------
+
+def run_case( path , data_dir , args ):
+    """
+    Runs one path in a fresh process and returns its peak RSS in MB, printed on its last line of output.
+    """
+    command = [ sys.executable , os.path.abspath( __file__ ) , '--case' , path , '--data_dir' , data_dir ,
+                '--members' , str( args.members ) , '--years' , str( args.years ) ,
+                '--precision' , args.precision , '--prefetch_depth' , str( args.prefetch_depth ) ]
+    output = subprocess.check_output( command , cwd = os.path.dirname( os.path.abspath( __file__ ) ) )
+
+    return float( output.strip().splitlines()[-1] )
+
+# ----------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description = 'Peak memory of the previous and current ImpactMetric loading and reduction' )
+    parser.add_argument( '--grid' , default = 'N96' , choices = sorted( grids.keys() ) )
+    parser.add_argument( '--members' , type = int , default = 10 )
+    parser.add_argument( '--years' , type = int , default = 30 )
+    parser.add_argument( '--precision' , default = cimt_settings.working_precision , choices = [ 'float32' , 'float64' , 'native' ] ,
+                         help = 'working_precision of the current path, by default the one of cimt_interface.ini' )
+    parser.add_argument( '--prefetch_depth' , type = int , default = cimt_settings.prefetch_depth ,
+                         help = 'prefetch_depth of the current path, by default the one of cimt_interface.ini' )
+    parser.add_argument( '--case' , choices = [ 'previous' , 'current' ] , help = argparse.SUPPRESS )
+    parser.add_argument( '--data_dir' , help = argparse.SUPPRESS )
+    args = parser.parse_args()
+
+    if args.case != None: # Child process, run one path on the members written by the parent and report its peak RSS
+        cimt_settings.working_precision = args.precision
+        cimt_settings.working_dtype = None if args.precision == 'native' else np.dtype( args.precision )
+        cimt_settings.prefetch_depth = args.prefetch_depth
+        if args.case == 'previous':
+            previous_path( args.data_dir , args.members , args.years )
+        else:
+            current_path( args.data_dir , args.members , args.years )
+        print peak_rss_mb()
+
+    else:
+        data_dir = tempfile.mkdtemp( prefix = 'cimt_benchmark_' )
+        try:
+            write_members( data_dir , grids[args.grid] , args.members , args.years )
+            previous = run_case( 'previous' , data_dir , args )
+            current = run_case( 'current' , data_dir , args )
+        finally:
+            shutil.rmtree( data_dir )
+
+        print 'Grid: ' + args.grid + ', members: ' + str( args.members ) + ', years: ' + str( args.years ) + \
+              ', working precision: ' + args.precision + ', prefetch depth: ' + str( args.prefetch_depth )
+        print 'Peak RSS previous path: %.1f MB' % previous
+        print 'Peak RSS current path:  %.1f MB' % current
+        print 'Reduction: %.0f%%' % ( 100.0 * ( previous - current ) / previous )
@@ -6,10 +6,21 @@ Climate Impact Metrics Tool 'metrics' file
 import iris
 
 import cimt_parent_metric
+import cimt_load_plan
 
 # ----------------------------------------------------------------------------------------------------
 # Define each metric here ( skeleton is given below ) ------------------------------------------------
 
+#class New_Metric( cimt_parent_metric.ImpactMetric ):
+#    """
+#    Child class for the New Metric.
+#    """
+#    definition = cimt_load_plan.MetricDefinition( 'Full_name_of_metric' , 'stash_number' , 'units' , unit_factor ,
+#                                                  level_coord = 'level_coord_name' , levels = [ levels ] )
+#
+# If the metric can't be declared with a definition, pass the attributes to the constructor and write
+# load_cube() by hand instead:
+#
 #class New_Metric( cimt_parent_metric.ImpactMetric ):
 #    """
 #    Child class for the New Metric.
@@ -29,14 +40,7 @@ class NPP( cimt_parent_metric.ImpactMetric ):
     """
     Child class for the Net Primary Productivity metric.
     """
-    def __init__( self ):
-        super( NPP , self ).__init__( 'Net_Primary_Productivity' , 'm01s03i262' , 'kg m^2 yr' , 31536000 , None )
-        
-    def load_cube( self , job ):
-        variable = iris.AttributeConstraint( STASH = self.stash )
-        cube = iris.load_cube( self.job_files_dict[job] , variable )
-        
-        return cube
+    definition = cimt_load_plan.MetricDefinition( 'Net_Primary_Productivity' , 'm01s03i262' , 'kg m^2 yr' , 31536000 )
     
 # ----------------------------------------------------------------------------------------------------
 
@@ -44,18 +48,7 @@ class T_ROFF( cimt_parent_metric.ImpactMetric ):
     """
     Child class for the Total Runoff metric.
     """
-    def __init__( self ):
-        super( T_ROFF , self ).__init__( 'Total_Runoff' , [ 'm01s08i235' , 'm01s08i234' ] , 'mm day^-1' , 86400.0 , None )
-       
-    def load_cube( self , job ):
-        variables = [] ; cubes_to_sum = []
-        for stash in range( 0 , len( self.stash ) ):
-            variables.append( iris.AttributeConstraint( STASH = self.stash[ stash ] ) )
-            cubes_to_sum.append( iris.load_cube( self.job_files_dict[job] , variables[ stash ] ) )
-              
-        cube = sum( cubes_to_sum )
-      
-        return cube
+    definition = cimt_load_plan.MetricDefinition( 'Total_Runoff' , [ 'm01s08i235' , 'm01s08i234' ] , 'mm day^-1' , 86400.0 )
     
 # ----------------------------------------------------------------------------------------------------
         
@@ -63,19 +56,9 @@ class SOILM_1m( cimt_parent_metric.ImpactMetric ):
     """
     Child class for the Soil Moisture (up to 1m) metric.
     """
-    def __init__( self ):
-        super( SOILM_1m , self ).__init__( 'Soil_Moisture_1m' , 'm01s08i223' , 'm^3 m^-3' , 1 , [ 1 , 2 , 3 ] )
-  
-    def load_cube( self , job ):
-        variable = iris.AttributeConstraint( STASH = self.stash )
-        cube = iris.load_cube( self.job_files_dict[job] , variable )
-        cubes_to_sum = []
-        for layer in range( 0 , len( self.cell_number ) ):
-            cubes_to_sum.append( cube.extract( iris.Constraint( soil_model_level_number = lambda cell: cell == self.cell_number[ layer ] ) ) )
-
-        cube = sum( cubes_to_sum )
-        
-        return cube
+    definition = cimt_load_plan.MetricDefinition( 'Soil_Moisture_1m' , 'm01s08i223' , 'm^3 m^-3' , 1 ,
+                                                  level_coord = 'soil_model_level_number' , levels = [ 1 , 2 , 3 ] ,
+                                                  level_reduction = 'sum' )
     
 # ----------------------------------------------------------------------------------------------------
     
@@ -83,11 +66,4 @@ class T1p5m( cimt_parent_metric.ImpactMetric ):
     """
     Child class for Temperature at 1.5M metric.
     """
-    def __init__( self ):
-        super( T1p5m , self ).__init__( 'Air_Temp_1.5m' , 'm01s03i236' , 'K' , 1 , None )
-       
-    def load_cube( self , job ):
-        variable = iris.AttributeConstraint( STASH = self.stash )
-        cube = iris.load_cube( self.job_files_dict[job] , variable )
-        
-        return cube
\ No newline at end of file
+    definition = cimt_load_plan.MetricDefinition( 'Air_Temp_1.5m' , 'm01s03i236' , 'K' , 1 )
@@ -3,21 +3,29 @@ cimt_parent_metric.py
 Climate Impact Metrics Tool 'parent-metric' file
 '''
 
-import abc
+import os
+import hashlib
+import numpy as np
 import iris
 import iris.coord_categorisation as cat
 from iris import analysis
+import iris.analysis.maths
 from collections import OrderedDict
 
 import cimt_utilities
 import cimt_settings
+import cimt_load_plan
+import cimt_streaming
+import cimt_data_service
+import cimt_rendering
+import cimt_time_series
+import cimt_trends
 
 
 # ----------------------------------------------------------------------------------------------------
 # Parent-class for an Impact Metric ------------------------------------------------------------------
 
 class ImpactMetric( object ):
-    __metaclass__ = abc.ABCMeta # For setting up an abstract method (used later)
     """
     This is the parent class impact metric, general methods are defined here and will be inherited for every
     new metric added. A general constructor is set up to declare attributes such as the metrics full name, 
@@ -25,6 +33,11 @@ class ImpactMetric( object ):
     
     To create a new metric, one can initiate a class (in the "cimt_metrics.py" file ) following the skeleton
     provided, in addition there will already be some examples of some current metrics installed.
+    
+    Most metrics only need a 'definition' (see "cimt_load_plan.py") which declares the stash number(s),
+    level selection and unit factor, the attributes below are then filled in from the definition and
+    load_cube() follows the compiled load plan. Metrics which need more manipulation can still pass the
+    attributes to the constructor and write their own load_cube().
     ----------------------------------------------------------------------------------------------------
     
     Some notes regarding how to specify attributes when defining a new class:
@@ -53,13 +66,29 @@ class ImpactMetric( object ):
         or max. and min. temperatures.  
         Default setting: cell_number = None.
     """
+    definition = None # Declarative metric definition, a cimt_load_plan.MetricDefinition
+    map_renderer = None # cimt_rendering.MapRenderer shared by all metrics, created when the first map is saved
+    
     # Constructor for parent class metric
     def __init__( self , full_name = None , stash = None , units = None , unit_factor = 1 , cell_number = None ):
+        if full_name == None and self.definition != None: # Take the attributes from the metric definition
+            full_name = self.definition.full_name
+            stash = self.definition.stash
+            units = self.definition.units
+            unit_factor = self.definition.unit_factor
+            cell_number = self.definition.levels
+            
         self.full_name = full_name
         self.stash = stash
         self.units = units
+        self.field_units = units # Units of the fields read, self.units is of the outputs (e.g. days for days_above)
         self.unit_factor = unit_factor
         self.cell_number = cell_number
+        
+        # Compile the definition into a single constrained load
+        self.load_plan = None
+        if self.definition != None:
+            self.load_plan = cimt_load_plan.LoadPlan( self.definition )
     
     # ----------------------------------------------------------------------------------------------------
     
@@ -81,18 +110,18 @@ class ImpactMetric( object ):
         
     # ----------------------------------------------------------------------------------------------------
     
-    @abc.abstractmethod # Abstract method to load a cube, method will be different for each metric
+    # Method to load a cube, follows the load plan of the metric definition unless overwritten
     def load_cube( self , job ):
         """
-        Method for loading a cube which makes use of iris.load_cube under certain constraints. These constraints
-        are defined as attributes for the class, such as its stash number or cell number. 
+        Method for loading a cube which makes use of iris.load under certain constraints. These constraints
+        are defined by the metric definition, such as its stash number(s) or level selection, and compiled
+        into a single load by cimt_load_plan.LoadPlan.
         
-        This method will be overwritten for each metric because there are varying levels of manipulation
-        that may need to be done before (or after) loading a cube. A variety of operations can be considered
-        such as using multiple stash numbers, accessing particular cell levels or addition/subraction of cubes.
+        This method can be overwritten for a metric which needs a manipulation that can't be declared in a
+        definition, e.g. addition/subtraction of cubes other than a sum over stash numbers.
         
-        The final result should always be a cube. This is an abstract method and so returns nothing, see the 
-        "cimt_metrics.py" file to see where to define load_cube() for a specific metric.
+        The final result should always be a cube, see the "cimt_metrics.py" file to see where to define
+        the definition (or load_cube()) for a specific metric.
         
         Parameters
         ----------
@@ -103,8 +132,11 @@ class ImpactMetric( object ):
         -------
         iris cube
             A cube which feeds into load_modify_cubes() and is iterated over the number of jobs in the joblist.
-        """        
-        return
+        """
+        if self.load_plan == None:
+            raise StandardError( "Metric " + self.__class__.__name__ + " needs either a definition or its own load_cube()" )
+        
+        return self.load_plan.load( self.job_files_dict[job] )
         
     # ----------------------------------------------------------------------------------------------------
     
@@ -148,58 +180,169 @@ class ImpactMetric( object ):
         self.job_files_dict = {}
         
         for job , jobname in jobs_dict.iteritems():
-            
-            if cimt_settings.period_type == 'annual':
-                self.job_files_dict[job] = cimt_utilities.get_apy_files( cimt_settings.DATADIR , jobs_dict[job] )
-                
-            elif cimt_settings.period_type == 'seasonal':
-                season = period
-                self.job_files_dict[job] = cimt_utilities.get_aps_files( cimt_settings.DATADIR , jobs_dict[job] , season )
-                
-            elif cimt_settings.period_type == 'monthly':
-                raise StandardError("Monthly files available soon!")
-                
-            else:
-                raise StandardError("Select a valid period type!")
+            self.job_files_dict[job] = cimt_utilities.get_files( cimt_settings.DATADIR , jobs_dict[job] , cimt_settings.period_type ,
+                                                                 period , cimt_settings.subdaily_streams )
             
         return self.job_files_dict
     
     # ----------------------------------------------------------------------------------------------------
-            
-    def load_modify_cubes( self , base_run = None , period = None , instance = None ):
+    
+    # Private method called (possibly from a background thread) within load_modify_cubes()
+    def __read_cube( self , job ):
         """
-        Method to load data from UM output files for job into an IRIS cube according to the constraints defined
-        in the metric class, and period defined in the user configuration file.
+        Calls load_cube(), which follows the load plan of the metric definition unless overwritten, and reads the data
+        from disk so that the file reads are done before the cube is handed back to load_modify_cubes().
         
-        Then modify the cube by changing its name and units, adding a 'year' coordinate
-        and update attributes.
+        Parameters
+        ----------
+        job: int
+            An iterator indicating the current job
+        
+        Returns
+        -------
+        iris cube
+            The cube returned by load_cube() with its data loaded into memory.
+        """
+        cube = self.load_cube( job )
+        cube.data # Touch the data so that the deferred read happens here
+        
+        return cube
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called (possibly from a background thread) within __stream_cube() and trend_analysis()
+    def __read_file_cube( self , filename ):
+        """
+        Loads a single file following the load plan, and converts it to the desired units so that thresholds
+        (e.g. for days above a threshold) are applied in the units of the metric.
+        
+        Parameters
+        ----------
+        filename : string
+            Full path of the file to load
+        
+        Returns
+        -------
+        iris cube
+            A cube of the time steps in the file, in the desired units.
+        """
+        cube = self.load_plan.load( [ filename ] )
+        cimt_utilities.scale_in_place( cube , self.unit_factor , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
+        cube.units = self.field_units
+        
+        return cube
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within load_modify_cubes()
+    def __stream_cube( self , job ):
+        """
+        Streams the sub-daily files of a job one at a time (reading the next files in the background) through
+        cimt_streaming.aggregate_stream(), and reduces the daily or monthly statistics of the years of the jobset
+        as they arrive: into a running time mean (cimt_streaming.TimeMeanAccumulator) and the area-mean series of
+        the member, kept in self.member_series. Only a few files and one field of sums are held in memory,
+        whatever the length of the run.
+        
+        Parameters
+        ----------
+        job: int
+            An iterator indicating the current job
+        
+        Returns
+        -------
+        iris cube
+            The time mean of the daily or monthly statistics, with a time dimension of length one, already in
+            the desired units.
+        """
+        if self.load_plan == None:
+            raise StandardError( "Sub-daily files can only be streamed for a metric with a definition, see cimt_load_plan.py" )
+        
+        files = cimt_utilities.prefetch( self.job_files_dict[job] , self.__read_file_cube ,
+                                         depth = cimt_settings.prefetch_depth ,
+                                         memory_cap = cimt_settings.prefetch_memory_cap ,
+                                         sizeof = lambda cube: cube.data.nbytes )
+        
+        aggregated = cimt_streaming.aggregate_stream( ( cube for filename , cube in files ) ,
+                                                      cimt_settings.subdaily_aggregation ,
+                                                      cimt_settings.subdaily_statistic ,
+                                                      cimt_settings.subdaily_threshold )
+        
+        accumulator = cimt_streaming.TimeMeanAccumulator()
+        dates = [] ; series = []
+        for cube in aggregated:
+            cube = cube.extract( iris.Constraint( year = lambda cell: self.start_year <= cell <= self.end_year ) )
+            if cube == None: # No step of this file in the years of the jobset
+                continue
+            step_dates , step_series = cimt_time_series.area_mean_series( [ cube ] )
+            dates.append( step_dates[0] ) ; series.append( step_series[0] )
+            accumulator.add( cube )
+        
+        if len( series ) == 0:
+            raise StandardError( "No sub-daily data between " + str( self.start_year ) + " and " + str( self.end_year ) +
+                                 " for " + str( self.jobs_dict[job] ) + ", check the years requested" )
+        
+        self.member_series[job] = ( np.concatenate( dates ) , np.concatenate( series ) )
+        
+        return accumulator.mean()
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within load_modify_cubes()
+    def __connect_data_service( self ):
+        """
+        Connects to the warm-data service (see "cimt_data_service.py") if client mode is chosen in the interface file.
+        
+        Returns
+        -------
+        cimt_data_service.DataServiceClient
+            A client, or None if client mode is off or no service is running.
+        """
+        if cimt_settings.data_service_mode != 'client':
+            return None
+        
+        return cimt_data_service.DataServiceClient.connect( cimt_settings.data_service_address , cimt_settings.data_service_key_file ,
+                                                          cimt_settings.data_service_group )
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within load_modify_cubes()
+    def __data_service_key( self , job ):
+        """
+        Returns the key of a member in the data service, which includes every setting the loaded cube depends on
+        and a digest of its files (names, sizes and modification times), so that a member cached while the run
+        was still writing output, or with years missing, isn't returned once its files change.
+        """
+        files = hashlib.sha1()
+        for filename in sorted( self.job_files_dict[job] ):
+            status = os.stat( filename )
+            files.update( filename + '\0' + str( status.st_size ) + '\0' + repr( status.st_mtime ) + '\n' )
+        
+        key = ( self.__class__.__name__ , cimt_settings.DATADIR , str( self.jobs_dict[job] ) , self.start_year , self.end_year ,
+                self.period , cimt_settings.working_precision , cimt_settings.downcast_float64 , files.hexdigest() )
+        
+        if cimt_settings.period_type == 'subdaily':
+            key += ( cimt_settings.subdaily_streams[ self.period.split( '_' )[0] ] , cimt_settings.subdaily_threshold )
+        
+        return key
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    def set_jobset( self , base_run = None , period = None , instance = None ):
+        """
+        Sets the attributes of the jobset the metric is for (job names, description, years and name) from
+        'cimt_settings.py', and empties the lists of cubes. Called by load_modify_cubes(), and on its own when
+        the members are computed elsewhere (see "cimt_distributed.py").
 
         Parameters
         ----------
         base_run : boolean
-            This is used as an identifier for the metric, when we flag this as true it tells the program
-            that the metric is defined to be a base run. The default setting is False.
+            True for the base jobset, False for a future jobset.
             
         period : string
             String input from the user indicating the types of files, e.g. 'ann' for annual
             
         instance : integer
-            This is used as an iterator when looping over a number of future joblists so that the program 
-            can extract information from 'cimt_settings.py' correctly
-
-        Returns
-        -------
-        metric.cubes
-            A list of cubes loaded for a specific metric.
-        
-        Example
-        -------
-        Load and modify cubes: 
-            BaseMetric.load_modify_cubes( base_run = True )
-        
-        Print list of cubes:
-            BaseMetric.cubes     
-        
+            The index of the future jobset, used when base_run is False.
         """
         self.base_run = base_run
         self.period = period
@@ -227,29 +370,111 @@ class ImpactMetric( object ):
             
         # Initialise some lists for storing loaded cubes, desired output cubes and jobnames (for internal naming)
         self.cubes = [] ; self.cubes_to_output = [] ; self.list_jobnames = []
+        self.member_series = {} # Area-mean series of streamed sub-daily members, computed as they are read
+        
+        if cimt_settings.period_type == 'subdaily': # The statistic is part of the name of the outputs
+            self.period = period + '_' + cimt_settings.subdaily_aggregation + '_' + cimt_settings.subdaily_statistic
+            
+            # A count of days is in days, the desired units of the metric only applied to the threshold
+            if cimt_settings.subdaily_statistic == 'days_above':
+                self.units = 'days'
+    
+    # ----------------------------------------------------------------------------------------------------
+            
+    def load_modify_cubes( self , base_run = None , period = None , instance = None , jobs = None ):
+        """
+        Method to load data from UM output files for job into an IRIS cube according to the constraints defined
+        in the metric class, and period defined in the user configuration file.
+        
+        Then modify the cube by changing its name and units, adding a 'year' coordinate
+        and update attributes.
+        
+        Sub-daily files are streamed and each member is reduced to its time mean as it is read (see
+        __stream_cube()), so its cube has a time dimension of length one and its area-mean series is kept
+        in self.member_series for area_mean_series().
+
+        Parameters
+        ----------
+        base_run : boolean
+            This is used as an identifier for the metric, when we flag this as true it tells the program
+            that the metric is defined to be a base run. The default setting is False.
+            
+        period : string
+            String input from the user indicating the types of files, e.g. 'ann' for annual
+            
+        instance : integer
+            This is used as an iterator when looping over a number of future joblists so that the program 
+            can extract information from 'cimt_settings.py' correctly
+            
+        jobs : list of strings
+            The members (keys of the joblist, e.g. 'base_job_ens1') to load, used to load a single member.
+            Default setting: jobs = None (all the members of the joblist).
+
+        Returns
+        -------
+        metric.cubes
+            A list of cubes loaded for a specific metric.
+        
+        Example
+        -------
+        Load and modify cubes: 
+            BaseMetric.load_modify_cubes( base_run = True )
+        
+        Print list of cubes:
+            BaseMetric.cubes     
+        
+        """
+        self.set_jobset( base_run , period , instance )
+        
+        # Restrict to the requested members of the joblist
+        jobs_dict = self.jobs_dict
+        if jobs != None:
+            jobs_dict = dict( ( job , self.jobs_dict[job] ) for job in jobs )
         
         # Get files for loading cubes, sort into numeric order with OrderedDict
-        self.job_files_dict = OrderedDict( sorted( self.__get_files( self.jobs_dict , period ).items() , key = lambda x: x[1] ) )
+        self.job_files_dict = OrderedDict( sorted( self.__get_files( jobs_dict , period ).items() , key = lambda x: x[1] ) )
         
-        # Loop over number of jobs in the joblist
+        # Check for mis-match between period and location of files before any loading starts
         for job , path in self.job_files_dict.iteritems():
-            
-            # Check for mis-match between period and location of files
             if len( self.job_files_dict[job] ) == 0:
                 raise StandardError("There is a problem loading the files requested, check that the period type matches the type of files requested in the string DATADIR")
-                
-             # Calls the abstract method load_cube() which is DIFFERENT depending on metric
-            cube = self.load_cube( job )           
+        
+        # Fetch the members already held by the data service, only the others are loaded from the files
+        data_service = self.__connect_data_service()
+        warm_cubes = {} ; loaded_cubes = {}
+        if data_service != None:
+            for job in self.job_files_dict.keys():
+                cached = data_service.fetch( self.__data_service_key( job ) )
+                if cached != None and cimt_settings.period_type == 'subdaily' and len( cached ) == 2: # Time mean and series
+                    warm_cubes[job] = cached[0]
+                    self.member_series[job] = cimt_time_series.member_series( cached[1] )
+                elif cached != None and cimt_settings.period_type != 'subdaily':
+                    warm_cubes[job] = cached[0]
+        jobs_to_load = [ job for job in self.job_files_dict.keys() if job not in warm_cubes ]
+        
+        if cimt_settings.period_type == 'subdaily':
+            # Each member is aggregated and reduced to its time mean file by file as it is read
+            member_cubes = ( ( job , self.__stream_cube( job ) ) for job in jobs_to_load )
+            
+        else:
+            # The next members are read in the background while this one is modified
+            member_cubes = cimt_utilities.prefetch( jobs_to_load , self.__read_cube ,
+                                                    depth = cimt_settings.prefetch_depth ,
+                                                    memory_cap = cimt_settings.prefetch_memory_cap ,
+                                                    sizeof = lambda cube: cube.data.nbytes )
+        
+        # Loop over number of jobs in the joblist
+        for job , cube in member_cubes:
                     
             print 'Loading Cube: ' + self.name + str( self.jobs_dict[job] ) + '_' + self.period
             
-            self.list_jobnames.append( str( self.jobs_dict[job] ) )
-            
             # Apply this to all cubes no matter the metric type
-            cat.add_year( cube , 'time' , name = 'year' ) # NB- Specific to annual, update attributes for cubes with other period types
+            if not cube.coords( 'year' ): # Sub-daily cubes already have a year from their aggregation
+                cat.add_year( cube , 'time' , name = 'year' )
         
-            cube = cube * self.unit_factor
-            cube.units = self.units
+            if cimt_settings.period_type != 'subdaily': # Sub-daily cubes are converted file by file as they are streamed
+                cimt_utilities.scale_in_place( cube , self.unit_factor , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
+                cube.units = self.units
             cube.rename( self.name + str( self.jobs_dict[job] ) + '_' + self.period )
             
             # Update cube.attributes for all cubes
@@ -258,14 +483,24 @@ class ImpactMetric( object ):
                                     'Stash Number': self.stash
                                     })
 
-            # Extract all yearly files within given range
-            if self.start_year != None:
+            # Extract all yearly files within given range, streamed sub-daily members only had those years
+            if self.start_year != None and cimt_settings.period_type != 'subdaily':
                 cube = cube.extract( iris.Constraint( year = lambda cell: self.start_year <= cell <= self.end_year ) )
                 
             # NB- Should use self.year_difference to check for requested files between those years
                 
-            # Append this cube to cubes
-            self.cubes.append( cube )
+            loaded_cubes[job] = cube
+            if data_service != None and cimt_settings.period_type == 'subdaily':
+                data_service.store( self.__data_service_key( job ) , [ cube , cimt_time_series.member_series_cube( *self.member_series[job] ) ] )
+            elif data_service != None:
+                data_service.store( self.__data_service_key( job ) , [ cube ] )
+        
+        # Append the cubes to cubes in the order of the joblist
+        for job in self.job_files_dict.keys():
+            if job in warm_cubes:
+                print 'Fetched Cube from data service: ' + warm_cubes[job].name()
+            self.list_jobnames.append( str( self.jobs_dict[job] ) )
+            self.cubes.append( warm_cubes[job] if job in warm_cubes else loaded_cubes[job] )
                         
         return self.cubes
     
@@ -294,17 +529,55 @@ class ImpactMetric( object ):
             input_cubes = self.cubes
         
         for job in range( len( input_cubes ) ):
-            self.maps.append( input_cubes[job].collapsed( 'time' , iris.analysis.MEAN ) )
-            
-            # Append cubes to output list based on interface choices
-            if cimt_settings.map_type == 'pre_subtraction' or cimt_settings.map_type == 'both':
-                if cimt_settings.subtraction_type == 'each_member' or cimt_settings.subtraction_type == 'both':
-                    self.cubes_to_output.append( input_cubes[job].collapsed( 'time' , iris.analysis.MEAN ) )
+            self.__add_map( input_cubes[job].collapsed( 'time' , iris.analysis.MEAN ) )
          
         return self.maps
     
     # ----------------------------------------------------------------------------------------------------
     
+    def restore_maps( self , maps , list_jobnames ):
+        """
+        Sets the maps of the members when their temporal means were computed elsewhere, e.g. by the workers
+        of "cimt_distributed.py", so that ensemble_mean(), subtract_cubes() and save_outputs() can follow as
+        they do after temporal_mean(). Call set_jobset() first.
+        
+        Parameters
+        ----------
+        maps : list of iris cubes
+            The temporal mean of each member, in the order of the joblist.
+            
+        list_jobnames : list of strings
+            The UM job name of each member.
+
+        Returns
+        -------
+        metric.maps
+            The list of maps.
+        """
+        self.maps = []
+        self.list_jobnames = list( list_jobnames )
+        
+        for time_mean in maps:
+            self.__add_map( time_mean )
+            
+        return self.maps
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within temporal_mean() and restore_maps()
+    def __add_map( self , time_mean ):
+        """
+        Appends the map of a member to self.maps, and to the output list based on interface choices.
+        """
+        self.maps.append( cimt_utilities.to_working_precision( time_mean , cimt_settings.working_dtype , cimt_settings.downcast_float64 ) )
+        
+        # The map is shared with the output list rather than collapsed again
+        if cimt_settings.map_type == 'pre_subtraction' or cimt_settings.map_type == 'both':
+            if cimt_settings.subtraction_type == 'each_member' or cimt_settings.subtraction_type == 'both':
+                self.cubes_to_output.append( time_mean )
+    
+    # ----------------------------------------------------------------------------------------------------
+    
     def spatial_mean( self , input_cubes = None ):
         """
         SpatialMean reduces the cubes dimensions to produce a mean value over the entire domain
@@ -345,6 +618,161 @@ class ImpactMetric( object ):
 
     # ----------------------------------------------------------------------------------------------------
     
+    def area_mean_series( self , input_cubes = None ):
+        """
+        Computes the area-weighted mean time series of every member in one vectorised pass per member (see
+        "cimt_time_series.py"), for the time series product written by cimt_time_series.save_time_series().
+        
+        Parameters
+        ----------
+        input_cubes : list of iris cubes
+            Choice for user to input desired input cubes, if left empty program will use self.cubes
+            Default setting: input_cubes = None.
+
+        Returns
+        -------
+        metric.area_means
+            A dictionary with the jobset 'description', member 'runids', and the 'dates' and 'series' of each member.
+            Streamed sub-daily members were reduced to their time mean as they were read, so by default their
+            series are the ones computed then.
+        """
+        if input_cubes == None and cimt_settings.period_type == 'subdaily': # Computed by __stream_cube()
+            dates = [ self.member_series[job][0] for job in self.job_files_dict.keys() ]
+            series = [ self.member_series[job][1] for job in self.job_files_dict.keys() ]
+        else:
+            if input_cubes == None: # If user doesn't specify input cubes set them to be equal to self.cubes
+                input_cubes = self.cubes
+            dates , series = cimt_time_series.area_mean_series( input_cubes )
+        
+        self.area_means = { 'description' : self.job_description , 'runids' : list( self.list_jobnames ) ,
+                            'dates' : dates , 'series' : series }
+        
+        return self.area_means
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    def trend_analysis( self , base_run = None , period = None , instance = None ):
+        """
+        Fits a least-squares linear trend to every grid cell over the years of the jobset, and computes its
+        p-value and the time of emergence (see "cimt_trends.py"). The files are read one at a time (the next
+        ones in the background) and each field is added to running sums, so only one field per member is held
+        in memory whatever the length of the run.
+        
+        Maps of the slope, p-value and time of emergence are added to the output list for each member and/or
+        for the ensemble (one fit to the fields of every member), following 'subtraction_type', and are saved
+        with save_outputs().
+        
+        Parameters
+        ----------
+        base_run : boolean
+            True for the base jobset, False for a future jobset.
+            
+        period : string
+            String input from the user indicating the types of files, e.g. 'ann' for annual
+            
+        instance : integer
+            The index of the future jobset, used when base_run is False.
+
+        Returns
+        -------
+        metric.trends
+            A list of 2D cubes of the trend (per year), its p-value and the year of emergence.
+        
+        Example
+        -------
+        BaseTrends = ImpactMetric()
+        BaseTrends.trend_analysis( base_run = True , period = 'ann' )
+        BaseTrends.save_outputs()
+        """
+        if self.load_plan == None:
+            raise StandardError( "Trends can only be streamed for a metric with a definition, see cimt_load_plan.py" )
+        
+        self.set_jobset( base_run , period , instance )
+        self.job_files_dict = OrderedDict( sorted( self.__get_files( self.jobs_dict , period ).items() , key = lambda x: x[1] ) )
+        for job , path in self.job_files_dict.iteritems():
+            if len( self.job_files_dict[job] ) == 0:
+                raise StandardError("There is a problem loading the files requested, check that the period type matches the type of files requested in the string DATADIR")
+        
+        each_member = cimt_settings.subtraction_type == 'each_member' or cimt_settings.subtraction_type == 'both'
+        ensemble = cimt_settings.subtraction_type == 'ensemble_mean' or cimt_settings.subtraction_type == 'both'
+        ensemble_sums = cimt_trends.TrendAccumulator( self.start_year )
+        self.trends = [] ; self.trend_slopes = []
+        
+        for job in self.job_files_dict.keys():
+            
+            print 'Fitting Trends: ' + self.name + str( self.jobs_dict[job] ) + '_' + self.period
+            self.list_jobnames.append( str( self.jobs_dict[job] ) )
+            member_sums = cimt_trends.TrendAccumulator( self.start_year )
+            template = None
+            
+            files = cimt_utilities.prefetch( self.job_files_dict[job] , self.__read_file_cube ,
+                                             depth = cimt_settings.prefetch_depth ,
+                                             memory_cap = cimt_settings.prefetch_memory_cap ,
+                                             sizeof = lambda cube: cube.data.nbytes )
+            
+            for filename , cube in files:
+                if not cube.coords( 'year' ):
+                    cat.add_year( cube , 'time' , name = 'year' )
+                for field in cube.slices( [ 'latitude' , 'longitude' ] ):
+                    year = int( field.coord( 'year' ).points[0] )
+                    if self.start_year <= year <= self.end_year:
+                        member_sums.add( year , field.data )
+                        if ensemble:
+                            ensemble_sums.add( year , field.data )
+                        template = field
+            
+            if template is None:
+                raise StandardError( "No fields found between " + str( self.start_year ) + " and " + str( self.end_year ) + " for " + str( self.jobs_dict[job] ) )
+            
+            if each_member:
+                self.__add_trends( member_sums.fit() , template , str( self.jobs_dict[job] ) )
+        
+        if ensemble:
+            self.__add_trends( ensemble_sums.fit() , template , 'Ensemble_' + self.job_description )
+        
+        return self.trends
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within trend_analysis()
+    def __add_trends( self , fit , template , label ):
+        """
+        Creates the slope, p-value and time of emergence cubes of a fit on the grid of a template field, and
+        appends them to self.trends and the output list.
+        """
+        emergence = cimt_trends.time_of_emergence( fit , self.start_year , self.end_year ,
+                                                   cimt_settings.emergence_threshold , cimt_settings.trend_significance )
+        
+        for quantity , data , units in [ ( 'Trend' , fit['slope'] , str( self.units ) + ' year-1' ) ,
+                                         ( 'Trend_P_Value' , fit['p_value'] , '1' ) ,
+                                         ( 'Time_Of_Emergence' , emergence , 'year' ) ]:
+            cube = template.copy( data = data )
+            for coord_name in [ 'time' , 'year' , 'forecast_period' , 'forecast_reference_time' ]: # Of the last field only
+                if cube.coords( coord_name ):
+                    cube.remove_coord( coord_name )
+            cimt_utilities.to_working_precision( cube , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
+            cube.units = units
+            cube.rename( self.name + label + '_' + quantity + '_' + self.period )
+            cube.attributes.update( { 'Trend years' : str( self.start_year ) + '-' + str( self.end_year ) ,
+                                      'Emergence threshold' : cimt_settings.emergence_threshold ,
+                                      'Trend significance' : cimt_settings.trend_significance } )
+            
+            self.trends.append( cube )
+            self.cubes_to_output.append( cube )
+            if quantity == 'Trend':
+                self.trend_slopes.append( cube )
+
+    # ----------------------------------------------------------------------------------------------------
+    
+    def release_cubes( self ):
+        """
+        Drops the loaded cubes once the maps (and time series) are computed, so that the metrics of every
+        jobset of a period can be kept until their outputs are saved together, with one set of colour scales.
+        """
+        self.cubes = []
+    
+    # ----------------------------------------------------------------------------------------------------
+    
     def ensemble_mean( self , input_cubes = None ):
         """
         Calculates a simple ensemble mean for any number of jobs (simulations) in a joblist and writes them into a
@@ -369,8 +797,11 @@ class ImpactMetric( object ):
         if len( input_cubes ) == 1: # Don't need to compute ensemble mean if only one job
             self.ens_mean = input_cubes[0]
             
-        elif len( input_cubes ) > 1: # Compute ensemble mean
-            self.ens_mean = ( sum( input_cubes ) / len( input_cubes ) )
+        elif len( input_cubes ) > 1: # Compute ensemble mean, accumulating in place into a single copy
+            self.ens_mean = cimt_utilities.to_working_precision( input_cubes[0].copy() , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
+            for cube in input_cubes[1:]:
+                iris.analysis.maths.add( self.ens_mean , cube , in_place = True )
+            iris.analysis.maths.divide( self.ens_mean , len( input_cubes ) , in_place = True )
             self.ens_mean.units = self.units
             self.ens_mean.rename( self.name + 'Ensemble_Mean_' + self.job_description + '_' + self.period  )
             
@@ -420,6 +851,7 @@ class ImpactMetric( object ):
                 raise StandardError( "Number of jobs in base and future metrics don't match" )
             for member in range( len( future_cubes ) ):
                 subtracted_cube = future_cubes[member] - base_cubes[member]
+                cimt_utilities.to_working_precision( subtracted_cube , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
                 subtracted_cube.units = self.units
                 subtracted_cube.rename( self.name + '[' + self.list_jobnames[member] + '-' + other.list_jobnames[member] + ']_(' + str( other.start_year ) + '-' + str( other.end_year ) + ')' + '_' + self.period )
                 self.subtracted_cubes.append( subtracted_cube )
@@ -430,6 +862,7 @@ class ImpactMetric( object ):
         if cimt_settings.subtraction_type == 'ensemble_mean' or cimt_settings.subtraction_type == 'both':
             
             subtracted_cube = self.ens_mean - other.ens_mean
+            cimt_utilities.to_working_precision( subtracted_cube , cimt_settings.working_dtype , cimt_settings.downcast_float64 )
             subtracted_cube.units = self.units
             subtracted_cube.rename( self.name + '[' + self.job_description + '-' + other.job_description + ']_(' + str( other.start_year ) + '-' + str( other.end_year ) + ')' + '_' + self.period )
             self.subtracted_cubes.append( subtracted_cube )
@@ -441,7 +874,113 @@ class ImpactMetric( object ):
     
     # ----------------------------------------------------------------------------------------------------
     
-    def save_outputs( self , other = None ):
+    @staticmethod
+    def colour_scales( metrics ):
+        """
+        Computes the colour scales of the maps of several metrics, e.g. every jobset (and trend) of a period,
+        in a single pass over all their outputs, so that every map they are compared with is drawn with the
+        same colours: one scale for the maps and one (centred on zero) for the anomalies and trends of each
+        units. If 'panel_summary' is chosen the maps in the summary figures are included.
+        
+        Parameters
+        ----------
+        metrics : list of metrics
+            The metrics whose outputs will be saved, after their maps are computed.
+
+        Returns
+        -------
+        dictionary
+            ( anomaly , units ) : ( vmin , vmax ), to pass to save_outputs().
+        
+        Example
+        -------
+        scales = ImpactMetric.colour_scales( [ BaseMetric ] + FutureMetrics )
+        for FutureMetric in FutureMetrics:
+            FutureMetric.save_outputs( BaseMetric , scales )
+        """
+        groups = OrderedDict()
+        for metric in metrics:
+            cubes = list( metric.cubes_to_output )
+            if cimt_settings.panel_summary:
+                cubes += getattr( metric , 'maps' , [] ) + getattr( metric , 'subtracted_cubes' , [] )
+                if getattr( metric , 'ens_mean' , None ) is not None:
+                    cubes.append( metric.ens_mean )
+            for cube in cubes:
+                groups.setdefault( metric.__scale_key( cube ) , [] ).append( cube )
+        
+        return dict( ( key , cimt_rendering.colour_limits( cubes , symmetric = key[0] ) ) for key , cubes in groups.iteritems() )
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within colour_scales() and __save_maps()
+    def __scale_key( self , cube ):
+        """
+        Returns the colour scale of an output map: anomalies and trends are drawn on scales centred on zero,
+        and each units has its own scale (e.g. trends, p-values and years of emergence don't share a scale).
+        """
+        anomalies = getattr( self , 'subtracted_cubes' , [] ) + getattr( self , 'trend_slopes' , [] )
+        return ( any( cube is anomaly for anomaly in anomalies ) , str( cube.units ) )
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    # Private method called within save_outputs()
+    def __save_maps( self , other = None , scales = None ):
+        """
+        Saves every output map as a .png file with the colour scales from colour_scales(). The projection and
+        coastlines are set up once per grid by the shared cimt_rendering.MapRenderer. If 'panel_summary' is
+        chosen in the interface file a single figure of base, future and anomaly maps is also saved.
+        
+        Parameters
+        ----------
+        other : metric
+            A metric which is usually the base metric
+            Default setting: other = None
+            
+        scales : dictionary
+            The colour scales, as returned by colour_scales().
+            Default setting: scales = None, computed from the outputs of this metric and other.
+        """
+        if ImpactMetric.map_renderer == None: # Shared by every metric so backgrounds are reused across jobsets and periods
+            ImpactMetric.map_renderer = cimt_rendering.MapRenderer()
+        
+        metrics = [ self ] if other == None else [ self , other ]
+        if scales == None:
+            scales = ImpactMetric.colour_scales( metrics )
+        
+        for metric in metrics:
+            for cube in metric.cubes_to_output:
+                outfile = cimt_settings.SAVEDIR + '/' + cube.long_name + '.png'
+                key = metric.__scale_key( cube )
+                ImpactMetric.map_renderer.render( cube , outfile , scales[key] , anomaly = key[0] )
+        
+        if cimt_settings.panel_summary and other != None:
+            
+            # One row per member (only members in both jobsets) and one for the ensemble mean: base, future, anomaly
+            members = range( min( len( self.maps ) , len( other.maps ) ) )
+            member_anomalies = [ None ] * len( self.maps )
+            ensemble_anomaly = None
+            if cimt_settings.subtraction_type == 'each_member' or cimt_settings.subtraction_type == 'both':
+                member_anomalies = self.subtracted_cubes[ : len( self.maps ) ]
+            if cimt_settings.subtraction_type == 'ensemble_mean' or cimt_settings.subtraction_type == 'both':
+                ensemble_anomaly = self.subtracted_cubes[-1]
+            
+            rows = [ [ other.maps[member] , self.maps[member] , member_anomalies[member] ] for member in members ]
+            rows.append( [ other.ens_mean , self.ens_mean , ensemble_anomaly ] )
+            row_labels = [ other.list_jobnames[member] + ' / ' + self.list_jobnames[member] for member in members ] + [ 'Ensemble mean' ]
+            column_labels = [ other.job_description + ' (' + str( other.start_year ) + '-' + str( other.end_year ) + ')' ,
+                              self.job_description + ' (' + str( self.start_year ) + '-' + str( self.end_year ) + ')' ,
+                              'Anomaly' ]
+            
+            panel_map_limits = scales.get( ( False , str( self.units ) ) , ( None , None ) )
+            panel_anomaly_limits = scales.get( ( True , str( self.units ) ) , ( None , None ) )
+            
+            outfile = cimt_settings.SAVEDIR + '/' + self.name + 'Summary_[' + self.job_description + '-' + other.job_description + ']_' + self.period + '.png'
+            ImpactMetric.map_renderer.render_panels( rows , outfile , row_labels , column_labels ,
+                                                     [ panel_map_limits , panel_map_limits , panel_anomaly_limits ] , anomaly_columns = [ 2 ] )
+    
+    # ----------------------------------------------------------------------------------------------------
+    
+    def save_outputs( self , other = None , scales = None ):
         """
         Saves maps and netcdf files according to the 'output_type' choice in the interface file.
         
@@ -450,13 +989,14 @@ class ImpactMetric( object ):
         other : metric
             A metric which is usually the base metric
             Default setting: other = None
+            
+        scales : dictionary
+            Colour scales of the maps from colour_scales(), pass the same scales to every jobset of a period
+            so that all their maps are drawn with the same colours.
+            Default setting: scales = None, computed from the outputs of this metric and other only.
         """
         if cimt_settings.output_type == 'map' or cimt_settings.output_type == 'both': # For saving data as a .png file
-            for map in range( len( self.cubes_to_output ) ):
-                cimt_utilities.save_map_png( cimt_settings.SAVEDIR , self.cubes_to_output[map].long_name , self.cubes_to_output[map] )
-            if other != None:
-                for map in range( len( other.cubes_to_output ) ):
-                    cimt_utilities.save_map_png( cimt_settings.SAVEDIR , other.cubes_to_output[map].long_name , other.cubes_to_output[map] )
+            self.__save_maps( other , scales )
         
         if cimt_settings.output_type == 'map_data' or cimt_settings.output_type == 'both': # For saving data as a .nc file
             for map in range( len( self.cubes_to_output ) ):
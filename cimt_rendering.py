@@ -0,0 +1,247 @@
+'''
+cimt_rendering.py
+Climate Impact Metrics Tool 'rendering' file
+'''
+
+import os
+import numpy as np
+import iris.plot as iplt
+import matplotlib.pyplot as plt
+import matplotlib.gridspec as gridspec
+import cartopy.crs as ccrs
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for consistent colour scales -------------------------------------------------------------
+
+def colour_limits( cubes , symmetric = False ):
+    """
+    Computes one colour scale for a set of maps in a single pass over their data, so that maps which
+    are compared with each other are drawn with the same colours.
+
+    Parameters
+    ----------
+    cubes : list of iris cubes
+        The maps which will share the colour scale, None entries are skipped.
+
+    symmetric : boolean
+        Centre the scale on zero, used for anomaly maps.
+        Default setting: symmetric = False.
+
+    Returns
+    -------
+    tuple
+        ( vmin , vmax ), or ( None , None ) if there is no valid data.
+    """
+    vmin = None ; vmax = None
+
+    for cube in cubes:
+        if cube is None:
+            continue
+        data = np.ma.masked_invalid( cube.data )
+        if data.count() == 0:
+            continue
+        low = float( data.min() ) ; high = float( data.max() )
+        vmin = low if vmin == None else min( vmin , low )
+        vmax = high if vmax == None else max( vmax , high )
+
+    if symmetric and vmin != None:
+        limit = max( abs( vmin ) , abs( vmax ) )
+        vmin , vmax = -limit , limit
+
+    return vmin , vmax
+
+# ----------------------------------------------------------------------------------------------------
+# Rendering engine -----------------------------------------------------------------------------------
+
+class MapRenderer( object ):
+    """
+    Draws many maps to .png files. The figure, map projection, coastlines and colour bar axes are set up
+    once per grid and kept, so for each map only the data layer (and its colour bar and title) is drawn.
+
+    Example
+    -------
+    renderer = MapRenderer()
+    limits = colour_limits( cubes )
+    for cube in cubes:
+        renderer.render( cube , SAVEDIR + '/' + cube.long_name + '.png' , limits )
+    renderer.close()
+    """
+    def __init__( self , figsize = ( 8 , 5.5 ) , cmap = 'viridis' , anomaly_cmap = 'RdBu_r' ):
+        self.figsize = figsize
+        self.cmap = cmap
+        self.anomaly_cmap = anomaly_cmap
+        self.backgrounds = {} # grid key : ( figure , map axes , colour bar axes )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def render( self , cube , outfile , limits = ( None , None ) , anomaly = False ):
+        """
+        Draws a single map and saves it, skipping files which already exist.
+
+        Parameters
+        ----------
+        cube : iris cube
+            A 2D (latitude, longitude) cube, or (grid_latitude, grid_longitude) on a rotated pole grid.
+
+        outfile : string
+            Full path of the .png file.
+
+        limits : tuple
+            ( vmin , vmax ) of the colour scale, e.g. from colour_limits().
+            Default setting: limits = ( None , None ), scaled to this map only.
+
+        anomaly : boolean
+            Use the diverging colour map for anomalies.
+            Default setting: anomaly = False.
+        """
+        if os.path.exists( outfile ):
+            print outfile , ' already exists. Please delete existing file first.'
+            return
+
+        print 'Saving Plot: ' , outfile
+        figure , axes , colour_bar_axes = self.__background( cube )
+
+        artists = self.__draw_data( figure , axes , colour_bar_axes , cube , limits , anomaly )
+        axes.set_title( cube.long_name , fontsize = 9 )
+        figure.savefig( outfile )
+
+        # Remove the data layer only, the background is kept for the next map on this grid
+        for artist in artists:
+            artist.remove()
+        colour_bar_axes.clear()
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def render_panels( self , rows , outfile , row_labels = None , column_labels = None , column_limits = None , anomaly_columns = () ):
+        """
+        Draws a grid of maps into one figure and saves it, e.g. members x scenarios or base/future/anomaly.
+        Each column has one colour scale and colour bar.
+
+        Parameters
+        ----------
+        rows : list of lists of iris cubes
+            The maps, one list per row. None leaves a panel empty.
+
+        outfile : string
+            Full path of the .png file.
+
+        row_labels , column_labels : list of strings
+            Labels drawn to the left of each row and above each column.
+            Default setting: None.
+
+        column_limits : list of tuples
+            ( vmin , vmax ) for each column. Columns can share a scale by passing the same limits.
+            Default setting: None, computed with colour_limits() for each column.
+
+        anomaly_columns : list of ints
+            The columns which hold anomalies, drawn with the diverging colour map and a scale centred on zero.
+        """
+        if os.path.exists( outfile ):
+            print outfile , ' already exists. Please delete existing file first.'
+            return
+
+        number_of_rows = len( rows )
+        number_of_columns = max( len( row ) for row in rows )
+        projection = self.__projection( next( cube for row in rows for cube in row if cube is not None ) )
+
+        if column_limits == None:
+            column_limits = [ colour_limits( [ row[column] for row in rows if column < len( row ) ] , column in anomaly_columns )
+                              for column in range( number_of_columns ) ]
+
+        print 'Saving Panels: ' , outfile
+        figure = plt.figure( figsize = ( 4 * number_of_columns , 2.4 * number_of_rows + 1 ) )
+        panels = gridspec.GridSpec( number_of_rows + 1 , number_of_columns , height_ratios = [ 1 ] * number_of_rows + [ 0.08 ] )
+
+        for column in range( number_of_columns ):
+            mesh = None
+            for row in range( number_of_rows ):
+                axes = figure.add_subplot( panels[row , column] , projection = projection )
+                axes.coastlines( linewidth = 0.5 )
+                cube = rows[row][column] if column < len( rows[row] ) else None
+                if cube is not None:
+                    plt.sca( axes )
+                    mesh = iplt.pcolormesh( cube , vmin = column_limits[column][0] , vmax = column_limits[column][1] ,
+                                            cmap = self.anomaly_cmap if column in anomaly_columns else self.cmap )
+                if row == 0 and column_labels != None:
+                    axes.set_title( column_labels[column] , fontsize = 9 )
+                if column == 0 and row_labels != None:
+                    axes.text( -0.05 , 0.5 , row_labels[row] , transform = axes.transAxes , rotation = 90 ,
+                               ha = 'right' , va = 'center' , fontsize = 8 )
+            if mesh is not None:
+                colour_bar = figure.colorbar( mesh , cax = figure.add_subplot( panels[number_of_rows , column] ) , orientation = 'horizontal' )
+                colour_bar.set_label( str( self.__units( rows , column ) ) , fontsize = 8 )
+
+        figure.savefig( outfile )
+        plt.close( figure )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def close( self ):
+        """
+        Closes the cached figures.
+        """
+        for figure , axes , colour_bar_axes in self.backgrounds.values():
+            plt.close( figure )
+        self.backgrounds = {}
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within render()
+    def __background( self , cube ):
+        """
+        Returns the cached figure, map axes and colour bar axes for the grid of a cube, setting them up
+        (projection, coastlines, layout) the first time the grid is seen.
+        """
+        # By axis, so that rotated pole grids (grid_latitude, grid_longitude) are keyed too
+        y_coord = cube.coord( axis = 'Y' ) ; x_coord = cube.coord( axis = 'X' )
+        key = ( str( cube.coord_system() ) , y_coord.shape , float( y_coord.points[0] ) , float( y_coord.points[-1] ) ,
+                x_coord.shape , float( x_coord.points[0] ) , float( x_coord.points[-1] ) )
+
+        if key not in self.backgrounds:
+            figure = plt.figure( figsize = self.figsize )
+            axes = figure.add_axes( [ 0.05 , 0.2 , 0.9 , 0.72 ] , projection = self.__projection( cube ) )
+            axes.coastlines( linewidth = 0.5 )
+            colour_bar_axes = figure.add_axes( [ 0.15 , 0.1 , 0.7 , 0.03 ] )
+            self.backgrounds[key] = ( figure , axes , colour_bar_axes )
+
+        return self.backgrounds[key]
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within render()
+    def __draw_data( self , figure , axes , colour_bar_axes , cube , limits , anomaly ):
+        """
+        Draws the data layer and its colour bar, returns the artists which were added to the map axes.
+        """
+        existing = set( axes.collections )
+        plt.figure( figure.number ) ; plt.sca( axes )
+        mesh = iplt.pcolormesh( cube , vmin = limits[0] , vmax = limits[1] , cmap = self.anomaly_cmap if anomaly else self.cmap )
+
+        colour_bar = figure.colorbar( mesh , cax = colour_bar_axes , orientation = 'horizontal' )
+        colour_bar.set_label( str( cube.units ) )
+
+        return [ artist for artist in axes.collections if artist not in existing ]
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within render() and render_panels()
+    def __projection( self , cube ):
+        """
+        Returns the cartopy projection of a cube, plain latitude/longitude if it has no coordinate system.
+        """
+        coord_system = cube.coord_system()
+        if coord_system == None:
+            return ccrs.PlateCarree()
+        return coord_system.as_cartopy_projection()
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within render_panels()
+    def __units( self , rows , column ):
+        """
+        Returns the units of the first map in a column.
+        """
+        for row in rows:
+            if column < len( row ) and row[column] is not None:
+                return row[column].units
+        return ''
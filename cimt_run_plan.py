@@ -0,0 +1,250 @@
+'''
+cimt_run_plan.py
+Climate Impact Metrics Tool 'run plan' file
+
+Resolves the configuration in 'cimt_interface.ini' into the work the tool will do, one task per
+(period, jobset, member), without loading any data: the files are found as they would be by
+ImpactMetric and only the .pp headers are read. Used by "python cimt_main.py --plan" to print the
+file counts, bytes and estimated peak memory before a run is submitted to the batch queue, and to
+fail fast on problems which would otherwise only show up hours into the run.
+'''
+
+import os
+import multiprocessing
+import iris.fileformats.pp as pp
+
+import cimt_utilities
+import cimt_settings
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for resolving the configuration ----------------------------------------------------------
+
+def get_jobsets():
+    """
+    Returns the jobsets of the run as a list of dictionaries, the base jobset first and then the future
+    jobsets (unless the comparison type is base_only).
+
+    Returns
+    -------
+    list of dictionaries
+        With keys: 'name', 'base_run', 'instance', 'description', 'start', 'end' and 'jobs' (job : runid).
+    """
+    jobsets = [ { 'name' : 'base_jobs' , 'base_run' : True , 'instance' : None ,
+                  'description' : cimt_settings.base_description ,
+                  'start' : int( cimt_settings.base_start ) , 'end' : int( cimt_settings.base_end ) ,
+                  'jobs' : cimt_settings.base_jobs_dict } ]
+
+    if cimt_settings.comparison_type != 'base_only':
+        for instance in range( cimt_settings.number_of_future_jobsets ):
+            jobsets.append( { 'name' : 'future_jobs_' + str( instance + 1 ) , 'base_run' : False , 'instance' : instance ,
+                              'description' : cimt_settings.future_description[instance] ,
+                              'start' : int( cimt_settings.future_start[instance] ) , 'end' : int( cimt_settings.future_end[instance] ) ,
+                              'jobs' : cimt_settings.future_jobs_dict[instance] } )
+
+    return jobsets
+
+# ----------------------------------------------------------------------------------------------------
+
+def read_headers( filenames ):
+    """
+    Reads the headers of every field in a list of .pp files, without reading or decoding the data.
+
+    Returns
+    -------
+    list of iris PPField
+        The fields, with deferred data.
+    """
+    fields = []
+    for filename in filenames:
+        fields.extend( pp.load( filename , read_data = False ) )
+
+    return fields
+
+# ----------------------------------------------------------------------------------------------------
+
+def field_year( field ):
+    """
+    Returns the year of a field as it will be given by iris.coord_categorisation.add_year: the year of the
+    middle of the meaning period for a time mean, and of the validity time otherwise.
+    """
+    if field.lbtim.ib == 2: # Time mean between t1 and t2
+        months = ( field.lbyr * 12 + field.lbmon - 1 + field.lbyrd * 12 + field.lbmond - 1 ) // 2
+        return months // 12
+    return field.lbyr
+
+# ----------------------------------------------------------------------------------------------------
+# The plan -------------------------------------------------------------------------------------------
+
+class RunPlan( object ):
+    """
+    The tasks of a run, with the inputs each will read and an estimate of their memory. Problems which
+    would stop the run are collected in 'problems' rather than raised straight away, so that one plan
+    reports all of them.
+
+    Example
+    -------
+    plan = RunPlan( ImpactMetric )
+    plan.print_plan()
+    plan.check()
+    """
+    def __init__( self , metric_class ):
+        self.metric = metric_class()
+        self.stash_codes = [ self.metric.stash ] if isinstance( self.metric.stash , basestring ) else list( self.metric.stash )
+        self.levels = self.metric.definition.levels if self.metric.definition != None else None
+
+        if cimt_settings.working_dtype is not None: # A float64 dtype compares equal to None
+            self.itemsize = cimt_settings.working_dtype.itemsize
+        else:
+            self.itemsize = 4 # .pp fields are stored as 32-bit
+
+        self.jobsets = get_jobsets()
+        self.tasks = []
+        self.problems = []
+
+        for period in cimt_settings.period_list:
+            for jobset in self.jobsets:
+                for job in sorted( jobset['jobs'].keys() , key = lambda job: jobset['jobs'][job] ):
+                    self.tasks.append( self.__plan_task( period , jobset , job ) )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    # Private method called within the constructor
+    def __plan_task( self , period , jobset , job ):
+        """
+        Finds the files of one member and reads their headers to fill in a task dictionary.
+        """
+        runid = jobset['jobs'][job]
+        task = { 'period' : period , 'jobset' : jobset['name'] , 'base_run' : jobset['base_run'] , 'instance' : jobset['instance'] ,
+                 'job' : job , 'runid' : runid , 'start' : jobset['start'] , 'end' : jobset['end'] ,
+                 'files' : [] , 'bytes' : 0 , 'fields' : 0 , 'loaded_bytes' : 0 , 'retained_bytes' : 0 }
+        label = period + ' ' + jobset['name'] + ' ' + runid
+
+        task['files'] = cimt_utilities.get_files( cimt_settings.DATADIR , runid , cimt_settings.period_type , period , cimt_settings.subdaily_streams )
+        if len( task['files'] ) == 0:
+            self.problems.append( label + ': no files found, check that the period type matches the type of files in DATADIR (' + cimt_settings.DATADIR + ')' )
+            return task
+
+        task['bytes'] = sum( os.path.getsize( filename ) for filename in task['files'] )
+
+        # Only the fields the load plan will select
+        fields = [ field for field in read_headers( task['files'] ) if str( field.stash ) in self.stash_codes ]
+        if self.levels != None:
+            fields = [ field for field in fields if field.lblev in self.levels ]
+        task['fields'] = len( fields )
+
+        found_stash = set( str( field.stash ) for field in fields )
+        for stash in self.stash_codes:
+            if stash not in found_stash:
+                self.problems.append( label + ': stash ' + stash + ' not found in its files' )
+
+        years = set( field_year( field ) for field in fields )
+        missing_years = [ year for year in range( task['start'] , task['end'] + 1 ) if year not in years ]
+        if len( fields ) > 0 and len( missing_years ) > 0:
+            self.problems.append( label + ': no data for the years ' + ', '.join( str( year ) for year in missing_years ) )
+
+        # Every selected field is decoded, only those in the requested years are kept after the level and stash reduction
+        field_bytes = max( [ field.lbrow * field.lbnpt for field in fields ] + [ 0 ] ) * self.itemsize
+        fields_per_step = len( self.stash_codes ) * ( len( self.levels ) if self.levels != None else 1 )
+        steps_in_range = len( [ field for field in fields if task['start'] <= field_year( field ) <= task['end'] ] ) // fields_per_step
+
+        if cimt_settings.period_type == 'subdaily': # Streamed one file at a time, aggregated and reduced to a time mean
+            fields_per_file = float( len( fields ) ) / len( task['files'] )
+            task['loaded_bytes'] = int( fields_per_file * field_bytes )
+            task['retained_bytes'] = field_bytes // self.itemsize * 12 + field_bytes # float64 sums and int32 counts of one field, then its mean
+        else:
+            task['loaded_bytes'] = len( fields ) * field_bytes
+            task['retained_bytes'] = steps_in_range * field_bytes
+
+        return task
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def jobset_peak_bytes( self , period , jobset_name ):
+        """
+        Estimated peak memory of loading one jobset: every member's cube is kept, while up to
+        prefetch_depth + 1 members (or files, when streaming) are being decoded at once.
+        """
+        tasks = [ task for task in self.tasks if task['period'] == period and task['jobset'] == jobset_name ]
+        if len( tasks ) == 0:
+            return 0
+        in_flight = min( cimt_settings.prefetch_depth + 1 , len( tasks ) )
+        return sum( task['retained_bytes'] for task in tasks ) + in_flight * max( task['loaded_bytes'] for task in tasks )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def peak_bytes( self ):
+        """
+        Estimated peak memory of the run as cimt_main.py does it: the jobsets are loaded in turn, and only
+        their 2D maps are kept once computed.
+        """
+        return max( [ self.jobset_peak_bytes( period , jobset['name'] ) for period in cimt_settings.period_list for jobset in self.jobsets ] + [ 0 ] )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def suggested_workers( self ):
+        """
+        Suggested number of worker processes for running the tasks in parallel: as many as fit in 80% of the
+        memory of this node, but no more than its CPUs or the number of tasks.
+        """
+        task_peak = max( [ task['loaded_bytes'] + task['retained_bytes'] for task in self.tasks ] + [ 1 ] )
+        try:
+            memory = os.sysconf( 'SC_PAGE_SIZE' ) * os.sysconf( 'SC_PHYS_PAGES' )
+        except ( ValueError , OSError , AttributeError ):
+            memory = task_peak
+        return max( 1 , min( multiprocessing.cpu_count() , len( self.tasks ) , int( 0.8 * memory // task_peak ) ) )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def print_plan( self ):
+        """
+        Prints the work graph with the file counts, bytes and memory estimate of every task.
+        """
+        print 'Run plan for ' + self.metric.__class__.__name__ + ' (' + self.metric.full_name + ')'
+        if self.metric.load_plan != None:
+            print '    ' + self.metric.load_plan.describe()
+        print '    DATADIR: ' + cimt_settings.DATADIR + ' , period type: ' + cimt_settings.period_type + ' , working precision: ' + cimt_settings.working_precision
+        print ''
+
+        for period in cimt_settings.period_list:
+            for jobset in self.jobsets:
+                print period + ' / ' + jobset['name'] + ': ' + jobset['description'] + ' (' + str( jobset['start'] ) + '-' + str( jobset['end'] ) + ')' + \
+                      ' , estimated peak ' + format_bytes( self.jobset_peak_bytes( period , jobset['name'] ) )
+                for task in self.tasks:
+                    if task['period'] == period and task['jobset'] == jobset['name']:
+                        print '    load %-10s %5d files %10s on disk %7d fields   decoded %10s   kept %10s' % \
+                              ( task['runid'] , len( task['files'] ) , format_bytes( task['bytes'] ) , task['fields'] ,
+                                format_bytes( task['loaded_bytes'] ) , format_bytes( task['retained_bytes'] ) )
+                print '    -> temporal_mean -> ensemble_mean' + ( ' -> subtract_cubes( base_jobs )' if not jobset['base_run'] else '' ) + ' -> save_outputs'
+            print ''
+
+        print 'Total: ' + str( len( self.tasks ) ) + ' tasks , ' + str( sum( len( task['files'] ) for task in self.tasks ) ) + ' files , ' + \
+              format_bytes( sum( task['bytes'] for task in self.tasks ) ) + ' to read'
+        print 'Estimated peak memory (cimt_main.py): ' + format_bytes( self.peak_bytes() )
+        print 'Suggested workers (one task each): ' + str( self.suggested_workers() )
+
+        if len( self.problems ) > 0:
+            print ''
+            print 'Problems:'
+            for problem in self.problems:
+                print '    ' + problem
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def check( self ):
+        """
+        Raises an error listing every problem found, if any.
+        """
+        if len( self.problems ) > 0:
+            raise StandardError( str( len( self.problems ) ) + " problem(s) found in the run plan:\n" + '\n'.join( self.problems ) )
+
+# ----------------------------------------------------------------------------------------------------
+
+def format_bytes( number ):
+    """
+    Returns a number of bytes as a short string, e.g. '1.5 GB'.
+    """
+    for unit in [ 'B' , 'kB' , 'MB' , 'GB' ]:
+        if abs( number ) < 1024.0:
+            return '%.1f %s' % ( number , unit )
+        number /= 1024.0
+    return '%.1f TB' % number
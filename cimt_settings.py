@@ -5,6 +5,7 @@ Climate Impact Metrics Tool 'settings' file
 
 import ConfigParser
 import ast
+import numpy as np
 
 # ----------------------------------------------------------------------------------------------------
 # Functions used in "cimt_settings.py" ---------------------------------------------------------------
@@ -42,7 +43,12 @@ def check_period(period):
     Checks if the input period is a valid option, and then allocates the period_type variable based
     on the user input. Common-sense User Warnings are also included to help user with debugging.
     """
-    if 'ann' in period:
+    if any(x in period for x in subdaily):
+        if len(period) != 1:
+            raise StandardError("In order to choose sub-daily files the period list must ONLY contain one of: " + ', '.join(subdaily))
+        period_type = 'subdaily'
+        
+    elif 'ann' in period:
         if len(period) != 1:
             raise StandardError("In order to choose annual the period list must ONLY contain the string 'ann'" )
         period_type = 'annual'
@@ -94,14 +100,81 @@ comparison_type = settings_dict['settings']['comparison_type']
 map_type = settings_dict['settings']['map_type']
 subtraction_type = settings_dict['settings']['subtraction_type']
 output_type = settings_dict['settings']['output_type']
+panel_summary = settings_dict['settings'].get( 'panel_summary' , 'False' ).strip().lower() == 'true'
+time_series = settings_dict['settings'].get( 'time_series' , 'off' )
+time_series_window = int( settings_dict['settings'].get( 'time_series_window' , 0 ) )
+time_series_window_type = settings_dict['settings'].get( 'time_series_window_type' , 'rolling' )
+if time_series not in ['off','netcdf','csv','both']:
+    raise StandardError("Choose a time_series output from: off, netcdf, csv, both")
+if time_series_window_type not in ['rolling','block']:
+    raise StandardError("Choose a time_series_window_type from: rolling, block")
+
+# ----------------------------------------------------------------------------------------------------
+# Extract performance settings, these are optional so fall back on defaults --------------------------
+performance_dict = settings_dict.get( 'performance' , {} )
+prefetch_depth = int( performance_dict.get( 'prefetch_depth' , 2 ) )
+prefetch_memory_cap = int( float( performance_dict.get( 'prefetch_memory_cap' , 2048 ) ) * 1024 ** 2 ) # MB to bytes
+if prefetch_depth < 0 or prefetch_memory_cap < 0:
+    raise StandardError("prefetch_depth and prefetch_memory_cap must be 0 or more")
+
+working_precision = performance_dict.get( 'working_precision' , 'float32' )
+if working_precision == 'native': # Keep the data type the data is stored in
+    working_dtype = None
+elif working_precision in ['float32','float64']:
+    working_dtype = np.dtype( working_precision )
+else:
+    raise StandardError("Choose a working_precision from: float32, float64, native")
+
+# Float64 inputs (e.g. netCDF observations) keep their precision unless narrowing them was asked for
+downcast_float64 = performance_dict.get( 'downcast_float64' , 'False' ).strip().lower() == 'true'
 
 # ----------------------------------------------------------------------------------------------------
 # Extract period list and apply appropriate checks ---------------------------------------------------
 seasons = ['djf','mam','jja','son']
 months = ['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec']
+subdaily = ['6hrly','3hrly']
 period_list = ast.literal_eval( Config.get( "settings" , "period" ) )
 period_type = check_period( period_list )
 
+# ----------------------------------------------------------------------------------------------------
+# Extract data service settings, these are optional so fall back on defaults -------------------------
+data_service_dict = settings_dict.get( 'data_service' , {} )
+data_service_mode = data_service_dict.get( 'mode' , 'off' )
+data_service_address = data_service_dict.get( 'address' , '' ).strip() or None # None: the default private socket
+data_service_key_file = data_service_dict.get( 'key_file' , '' ).strip() or None
+data_service_group = data_service_dict.get( 'group' , '' ).strip() or None # None: a per-user service
+if data_service_mode not in ['off','client']:
+    raise StandardError("Choose a data service mode from: off, client")
+
+# ----------------------------------------------------------------------------------------------------
+# Extract sub-daily settings, only needed when the period is sub-daily -------------------------------
+subdaily_dict = settings_dict.get( 'subdaily' , {} )
+subdaily_aggregation = subdaily_dict.get( 'aggregation' , 'monthly' )
+subdaily_statistic = subdaily_dict.get( 'statistic' , 'mean' )
+subdaily_threshold = subdaily_dict.get( 'threshold' )
+if subdaily_threshold != None:
+    subdaily_threshold = float( subdaily_threshold )
+subdaily_streams = { '6hrly' : subdaily_dict.get( 'stream_6hrly' , 'a.pa' ) ,
+                     '3hrly' : subdaily_dict.get( 'stream_3hrly' , 'a.pb' ) }
+
+# The options of cimt_streaming.aggregation_coords and cimt_streaming.statistics
+if subdaily_aggregation not in ['daily','monthly']:
+    raise StandardError("Choose a sub-daily aggregation from: daily, monthly")
+if subdaily_statistic not in ['mean','max','min','days_above']:
+    raise StandardError("Choose a sub-daily statistic from: mean, max, min, days_above")
+if period_type == 'subdaily' and subdaily_statistic == 'days_above' and subdaily_threshold == None:
+    raise StandardError("Set a threshold in the [subdaily] section to count days above a threshold")
+
+# ----------------------------------------------------------------------------------------------------
+# Extract trend settings -----------------------------------------------------------------------------
+trends_dict = settings_dict.get( 'trends' , {} )
+trend_analysis = trends_dict.get( 'trend_analysis' , 'off' ).strip().lower() == 'on'
+emergence_threshold = float( trends_dict.get( 'emergence_threshold' , 2 ) )
+trend_significance = float( trends_dict.get( 'trend_significance' , 0.05 ) )
+
+if trend_analysis and period_type == 'subdaily':
+    raise StandardError("Trend analysis needs one field per year, choose an annual, seasonal or monthly period")
+
 # ----------------------------------------------------------------------------------------------------
 # Extract settings of the base job -------------------------------------------------------------------
 base_description = settings_dict['base_jobs']['base_description'] 
@@ -0,0 +1,257 @@
+'''
+cimt_streaming.py
+Climate Impact Metrics Tool 'streaming' file
+'''
+
+import numpy as np
+import iris
+import iris.util
+import iris.coord_categorisation as cat
+from iris import analysis
+
+# ----------------------------------------------------------------------------------------------------
+# Options for aggregating sub-daily (6-hourly/3-hourly) output ---------------------------------------
+
+# Coordinates which define one group of time steps for each aggregation
+aggregation_coords = { 'daily' : [ 'year' , 'month_number' , 'day_of_month' ] ,
+                       'monthly' : [ 'year' , 'month_number' ]
+                       }
+
+statistics = { 'mean' : iris.analysis.MEAN ,
+               'max' : iris.analysis.MAX ,
+               'min' : iris.analysis.MIN ,
+               'days_above' : None # Derived index, see aggregate_cube()
+               }
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for streaming sub-daily files ------------------------------------------------------------
+
+def add_time_categories( cube , aggregation ):
+    """
+    Adds the categorisation coordinates needed to group the time steps of a cube for an aggregation,
+    skipping any which are already present.
+
+    Parameters
+    ----------
+    cube : iris cube
+        A cube with a 'time' coordinate.
+
+    aggregation : string
+        Either 'daily' or 'monthly'.
+    """
+    if not cube.coords( 'year' ):
+        cat.add_year( cube , 'time' , name = 'year' )
+    if not cube.coords( 'month_number' ):
+        cat.add_month_number( cube , 'time' , name = 'month_number' )
+    if aggregation == 'daily' and not cube.coords( 'day_of_month' ):
+        cat.add_day_of_month( cube , 'time' , name = 'day_of_month' )
+
+    return cube
+
+# ----------------------------------------------------------------------------------------------------
+
+def aggregate_cube( cube , aggregation , statistic , threshold = None ):
+    """
+    Aggregates the time steps of a cube, which should hold only complete days (or months), to daily or
+    monthly statistics.
+
+    Parameters
+    ----------
+    cube : iris cube
+        A cube of sub-daily time steps.
+
+    aggregation : string
+        Either 'daily' or 'monthly'.
+
+    statistic : string
+        One of 'mean', 'max', 'min' or 'days_above'. 'days_above' counts the days on which the daily
+        maximum is above the threshold, e.g. hot days for T1p5m.
+
+    threshold : float
+        Threshold for 'days_above', in the units of the cube.
+        Default setting: threshold = None.
+
+    Returns
+    -------
+    iris cube
+        A cube with one time step per day (or month).
+    """
+    add_time_categories( cube , 'daily' if statistic == 'days_above' else aggregation )
+
+    if statistic != 'days_above':
+        return cube.aggregated_by( aggregation_coords[aggregation] , statistics[statistic] )
+
+    if threshold == None:
+        raise StandardError( "A threshold must be given to count days above a threshold" )
+
+    # Reduce to daily maxima first, so that each day is counted once whatever the number of time steps
+    daily_max = cube.aggregated_by( aggregation_coords['daily'] , iris.analysis.MAX )
+    for coord_name in set( aggregation_coords['daily'] ) - set( aggregation_coords[aggregation] ):
+        daily_max.remove_coord( coord_name )
+
+    days_above = daily_max.aggregated_by( aggregation_coords[aggregation] , iris.analysis.COUNT ,
+                                          function = lambda values: values > threshold )
+    days_above.units = 'days'
+
+    return days_above
+
+# ----------------------------------------------------------------------------------------------------
+
+def aggregate_stream( cubes , aggregation , statistic , threshold = None ):
+    """
+    Generator which aggregates a stream of sub-daily cubes (usually one per file, in time order) to daily
+    or monthly statistics as they arrive. Only one file plus the last, possibly incomplete, day (or month)
+    is held in memory at a time. That last group is carried over and joined to the next cube, so a day
+    (or month) split across two files is still aggregated as a whole.
+
+    Parameters
+    ----------
+    cubes : iterable of iris cubes
+        Sub-daily cubes with a 'time' dimension, in time order.
+
+    aggregation : string
+        Either 'daily' or 'monthly'.
+
+    statistic : string
+        One of 'mean', 'max', 'min' or 'days_above', see aggregate_cube().
+
+    threshold : float
+        Threshold for 'days_above', in the units of the cubes.
+        Default setting: threshold = None.
+
+    Returns
+    -------
+    generator
+        Yields one aggregated cube per input cube, holding every group completed by that cube.
+    """
+    if aggregation not in aggregation_coords:
+        raise StandardError( "Choose a sub-daily aggregation from: " + ', '.join( sorted( aggregation_coords.keys() ) ) )
+    if statistic not in statistics:
+        raise StandardError( "Choose a sub-daily statistic from: " + ', '.join( sorted( statistics.keys() ) ) )
+
+    carry = None
+
+    for cube in cubes:
+        if not cube.coord_dims( 'time' ): # A file holding a single time step
+            cube = iris.util.new_axis( cube , 'time' )
+            
+        if carry is not None:
+            cube = iris.cube.CubeList( [ carry , cube ] ).concatenate_cube()
+
+        # Find where the last group starts, everything before it is complete
+        time_dim = cube.coord_dims( 'time' )[0]
+        keys = [ group_key( date , aggregation ) for date in cube.coord( 'time' ).units.num2date( cube.coord( 'time' ).points ) ]
+        last_start = len( keys ) - 1
+        while last_start > 0 and keys[last_start - 1] == keys[-1]:
+            last_start -= 1
+
+        carry = cube[ time_slice( cube , time_dim , last_start , None ) ]
+        if last_start > 0:
+            yield aggregate_cube( cube[ time_slice( cube , time_dim , None , last_start ) ] , aggregation , statistic , threshold )
+
+    if carry is not None: # The end of the stream completes the last group
+        yield aggregate_cube( carry , aggregation , statistic , threshold )
+
+# ----------------------------------------------------------------------------------------------------
+# Running reduction of the aggregated stream ---------------------------------------------------------
+
+class TimeMeanAccumulator( object ):
+    """
+    Running time mean of a stream of cubes, e.g. the daily or monthly statistics yielded by aggregate_stream(),
+    so that a run of any length is reduced while holding only the sum and the count of one field. As with a
+    collapse by iris.analysis.MEAN, masked time steps are left out of the mean of the cells they mask.
+
+    Example
+    -------
+    accumulator = TimeMeanAccumulator()
+    for cube in aggregate_stream( cubes , 'monthly' , 'mean' ):
+        accumulator.add( cube )
+    time_mean = accumulator.mean()
+    """
+    def __init__( self ):
+        self.template = None # The first time step, gives the coordinates of the mean, created with the first cube
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def add( self , cube ):
+        """
+        Adds the time steps of a cube to the sums.
+
+        Parameters
+        ----------
+        cube : iris cube
+            A cube with a 'time' coordinate, the same grid every time.
+        """
+        if not cube.coord_dims( 'time' ): # A single time step
+            cube = iris.util.new_axis( cube , 'time' )
+        time_dim = cube.coord_dims( 'time' )[0]
+
+        data = np.rollaxis( cube.data , time_dim ) # Time first, a view
+        valid = ~np.ma.getmaskarray( data )
+        values = np.where( valid , np.ma.getdata( data ) , 0 )
+
+        time = cube.coord( 'time' )
+        limits = time.bounds if time.has_bounds() else time.points
+
+        if self.template is None:
+            self.template = cube[ time_slice( cube , time_dim , 0 , 1 ) ].copy()
+            self.time_dim = time_dim
+            self.dtype = data.dtype if data.dtype.kind == 'f' else np.dtype( np.float64 )
+            self.total = np.zeros( values.shape[1:] ) ; self.count = np.zeros( values.shape[1:] , dtype = np.int32 )
+            self.start = limits.min() ; self.end = limits.max()
+
+        self.total += values.sum( axis = 0 , dtype = np.float64 )
+        self.count += valid.sum( axis = 0 , dtype = np.int32 )
+        self.start = min( self.start , limits.min() ) ; self.end = max( self.end , limits.max() )
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def mean( self ):
+        """
+        Returns the time mean of every cube added.
+
+        Returns
+        -------
+        iris cube
+            The mean, with a time dimension of length one whose bounds span every time step added, so that
+            it can still be collapsed over time like the full cube. Cells with no valid step are masked.
+        """
+        if self.template is None:
+            raise StandardError( "No cubes were added to the time mean" )
+
+        with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+            data = ( self.total / self.count ).astype( self.dtype )
+        if ( self.count == 0 ).any():
+            data = np.ma.masked_array( data , mask = ( self.count == 0 ) )
+
+        cube = self.template.copy( data = np.expand_dims( data , self.time_dim ) )
+        time = cube.coord( 'time' )
+        time.bounds = None
+        time.points = [ ( self.start + self.end ) / 2.0 ]
+        time.bounds = [ [ self.start , self.end ] ]
+        for coord_name in [ 'year' , 'month_number' , 'day_of_month' ]: # Categories of the first step only
+            if cube.coords( coord_name ):
+                cube.remove_coord( coord_name )
+
+        return cube
+
+# ----------------------------------------------------------------------------------------------------
+
+def group_key( date , aggregation ):
+    """
+    Returns the (year, month[, day]) key of the group a date belongs to.
+    """
+    if aggregation == 'daily':
+        return ( date.year , date.month , date.day )
+    return ( date.year , date.month )
+
+# ----------------------------------------------------------------------------------------------------
+
+def time_slice( cube , time_dim , start , stop ):
+    """
+    Returns an index tuple which slices a cube between start and stop along its time dimension only.
+    """
+    index = [ slice( None ) ] * cube.ndim
+    index[time_dim] = slice( start , stop )
+
+    return tuple( index )
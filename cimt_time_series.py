@@ -0,0 +1,300 @@
+'''
+cimt_time_series.py
+Climate Impact Metrics Tool 'time series' file
+'''
+
+import os
+import csv
+import numpy as np
+import iris
+import iris.analysis.cartography
+import iris.coords
+import iris.cube
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for computing area-mean time series ------------------------------------------------------
+
+def area_mean_series( cubes , dtype = np.float64 ):
+    """
+    Computes the area-weighted mean over latitude/longitude of every time step of every cube. The grid
+    area weights are computed once, and each cube is reduced with a single matrix-vector product over
+    all of its time steps instead of one weighted collapse per cube.
+
+    Parameters
+    ----------
+    cubes : list of iris cubes
+        Cubes of the same (time, latitude, longitude) grid, e.g. the members of a jobset (metric.cubes).
+
+    dtype : numpy dtype
+        Type of the returned series, the sums are always accumulated in float64.
+        Default setting: dtype = numpy.float64.
+
+    Returns
+    -------
+    dates : list of numpy arrays
+        The ( year , month , day ) of each time step, one ( time , 3 ) array per cube, so that the steps of
+        sub-daily data aggregated to days or months can be told apart.
+
+    series : list of numpy arrays
+        The area-weighted means, one array per cube. Time steps with no valid data are NaN.
+    """
+    dates = [] ; series = []
+    if len( cubes ) == 0:
+        return dates , series
+
+    # Area weights from one latitude/longitude slice, shared by every time step and cube
+    template = next( cubes[0].slices( [ 'latitude' , 'longitude' ] ) )
+    for coord_name in [ 'latitude' , 'longitude' ]:
+        if not template.coord( coord_name ).has_bounds():
+            template.coord( coord_name ).guess_bounds()
+    weights = iris.analysis.cartography.area_weights( template ).astype( np.float64 ).ravel()
+
+    for cube in cubes:
+        time_dim = cube.coord_dims( 'time' )
+        data = cube.data
+        if len( time_dim ) == 0: # A single time step
+            data = data[np.newaxis]
+        else:
+            data = np.rollaxis( data , time_dim[0] ) # Time first, a view
+        data = data.reshape( data.shape[0] , -1 )
+
+        valid = ~np.ma.getmaskarray( data ) & np.isfinite( np.ma.getdata( data ) )
+        values = np.where( valid , np.ma.getdata( data ) , 0 )
+
+        weight_sums = valid.dot( weights )
+        with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+            means = values.dot( weights ) / weight_sums
+        means[ weight_sums == 0 ] = np.nan
+
+        time = cube.coord( 'time' )
+        dates.append( np.array( [ [ date.year , date.month , date.day ] for date in np.atleast_1d( time.units.num2date( time.points ) ) ] ,
+                                dtype = np.int32 ).reshape( -1 , 3 ) )
+        series.append( means.astype( dtype ) )
+
+    return dates , series
+
+# ----------------------------------------------------------------------------------------------------
+
+def member_series_cube( dates , series ):
+    """
+    Wraps the area-mean series of one member in a (time_step) cube, with the year, month and day of each
+    step as coordinates, e.g. to hold it in the data service next to the member's streamed time mean.
+    """
+    cube = iris.cube.Cube( series , long_name = 'area_mean' )
+    cube.add_dim_coord( iris.coords.DimCoord( np.arange( len( series ) , dtype = np.int32 ) , long_name = 'time_step' ) , 0 )
+    for index , coord_name in enumerate( [ 'year' , 'month' , 'day' ] ):
+        cube.add_aux_coord( iris.coords.AuxCoord( dates[:, index] , long_name = coord_name ) , 0 )
+
+    return cube
+
+# ----------------------------------------------------------------------------------------------------
+
+def member_series( cube ):
+    """
+    Returns the ( dates , series ) of one member from a cube made by member_series_cube().
+    """
+    dates = np.column_stack( [ cube.coord( coord_name ).points for coord_name in [ 'year' , 'month' , 'day' ] ] ).astype( np.int32 )
+
+    return dates.reshape( -1 , 3 ) , np.asarray( cube.data )
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for stacking and smoothing ---------------------------------------------------------------
+
+def stack_series( jobsets ):
+    """
+    Stacks the area-mean series of several jobsets into one (jobset, member, time) array. Jobsets or
+    members with fewer members or time steps are padded with NaN.
+
+    Parameters
+    ----------
+    jobsets : list of dictionaries
+        One per jobset, as returned by ImpactMetric.area_mean_series(), with keys 'description',
+        'runids', 'dates' and 'series'.
+
+    Returns
+    -------
+    values : numpy array
+        The (jobset, member, time) series.
+
+    dates : numpy array
+        The (jobset, time, 3) year, month and day of each time step, -1 for padding.
+    """
+    number_of_members = max( len( jobset['series'] ) for jobset in jobsets )
+    number_of_steps = max( [ len( member ) for jobset in jobsets for member in jobset['series'] ] + [ 0 ] )
+
+    values = np.full( ( len( jobsets ) , number_of_members , number_of_steps ) , np.nan )
+    dates = np.full( ( len( jobsets ) , number_of_steps , 3 ) , -1 , dtype = np.int32 )
+
+    for index , jobset in enumerate( jobsets ):
+        for member , series in enumerate( jobset['series'] ):
+            values[index , member , : len( series )] = series
+            dates[index , : len( jobset['dates'][member] )] = jobset['dates'][member] # Members of a jobset share their dates
+
+    return values , dates
+
+# ----------------------------------------------------------------------------------------------------
+
+def rolling_mean( values , window ):
+    """
+    Trailing rolling mean along the last (time) axis of an array of any shape, computed
+    for every series at once with cumulative sums. Windows with any missing (NaN) step are NaN.
+
+    Returns
+    -------
+    numpy array
+        Same shape as values, the first window - 1 steps are NaN.
+    """
+    result = np.full( values.shape , np.nan )
+    if window < 1 or values.shape[-1] < window:
+        return result
+
+    valid = np.isfinite( values )
+    sums = np.cumsum( np.where( valid , values , 0 ) , axis = -1 )
+    counts = np.cumsum( valid , axis = -1 )
+    zeros = np.zeros( values.shape[:-1] + ( 1 , ) )
+    sums = np.concatenate( [ zeros , sums ] , axis = -1 )
+    counts = np.concatenate( [ zeros , counts ] , axis = -1 )
+
+    window_sums = sums[..., window:] - sums[..., :-window]
+    window_counts = counts[..., window:] - counts[..., :-window]
+    with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+        result[..., window - 1:] = np.where( window_counts == window , window_sums / window , np.nan )
+
+    return result
+
+# ----------------------------------------------------------------------------------------------------
+
+def block_mean( values , window ):
+    """
+    Mean over consecutive, non-overlapping blocks (e.g. decades) along the last (time) axis of an array
+    of any shape, for every series at once. Missing (NaN) steps are left out of a block's mean.
+
+    Returns
+    -------
+    numpy array
+        The block means, with ceil( time / window ) steps.
+    """
+    number_of_blocks = -( -values.shape[-1] // window )
+    padded = np.full( values.shape[:-1] + ( number_of_blocks * window , ) , np.nan )
+    padded[..., : values.shape[-1]] = values
+    blocks = padded.reshape( values.shape[:-1] + ( number_of_blocks , window ) )
+
+    valid = np.isfinite( blocks )
+    counts = valid.sum( axis = -1 )
+    with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+        return np.where( counts > 0 , np.where( valid , blocks , 0 ).sum( axis = -1 ) / counts , np.nan )
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for writing the time series product ------------------------------------------------------
+
+def save_time_series( data_dir , file_name , jobsets , units , output = 'netcdf' , window = 0 , window_type = 'rolling' ):
+    """
+    Writes the area-mean time series of every member of every jobset to one netCDF and/or csv file.
+
+    Parameters
+    ----------
+    data_dir : string
+        A full path to output files location
+
+    file_name : string
+        A meaningful output file name, without extension.
+
+    jobsets : list of dictionaries
+        One per jobset, as returned by ImpactMetric.area_mean_series().
+
+    units : string
+        Units of the series.
+
+    output : string
+        'netcdf', 'csv' or 'both'.
+        Default setting: output = 'netcdf'.
+
+    window : int
+        Length in time steps (years, or the days or months of aggregated sub-daily data) of the rolling or
+        block mean also written, 0 for none.
+        Default setting: window = 0.
+
+    window_type : string
+        'rolling' or 'block' (e.g. decadal means with window = 10 for annual data).
+        Default setting: window_type = 'rolling'.
+    """
+    values , dates = stack_series( jobsets )
+
+    smoothed = None ; smoothed_dates = None
+    if window > 1:
+        if window_type == 'block':
+            smoothed = block_mean( values , window )
+            smoothed_dates = dates[:, ::window] # First step of each block
+        else:
+            smoothed = rolling_mean( values , window )
+            smoothed_dates = dates # Last step of each trailing window
+
+    if output == 'netcdf' or output == 'both':
+        write_time_series_netcdf( data_dir + '/' + file_name + '.nc' , jobsets , values , dates , units , smoothed , smoothed_dates , window , window_type )
+
+    if output == 'csv' or output == 'both':
+        write_time_series_csv( data_dir + '/' + file_name + '.csv' , jobsets , values , dates , smoothed , smoothed_dates , window , window_type )
+
+# ----------------------------------------------------------------------------------------------------
+
+def write_time_series_netcdf( outfile , jobsets , values , dates , units , smoothed = None , smoothed_dates = None , window = 0 , window_type = 'rolling' ):
+    """
+    Writes the stacked (jobset, member, time) series as cubes in a single netCDF file.
+    """
+    if os.path.exists( outfile ):
+        print outfile , ' already exists. Please delete existing file first.'
+        return
+
+    cubes = iris.cube.CubeList( [ series_cube( 'area_mean' , values , dates , units , jobsets ) ] )
+    if smoothed is not None:
+        cubes.append( series_cube( 'area_mean_' + window_type + '_' + str( window ) , smoothed , smoothed_dates , units , jobsets ) )
+
+    print 'Saving netCDF: ' , outfile
+    iris.fileformats.netcdf.save( cubes , outfile )
+
+# ----------------------------------------------------------------------------------------------------
+
+def series_cube( name , values , dates , units , jobsets ):
+    """
+    Returns a (jobset, member, time) cube of series, with the year, month and day of each step as
+    (jobset, time) coordinates.
+    """
+    cube = iris.cube.Cube( values.astype( np.float32 ) , long_name = name , units = units )
+    cube.add_dim_coord( iris.coords.DimCoord( np.arange( values.shape[0] , dtype = np.int32 ) , long_name = 'jobset' ) , 0 )
+    cube.add_dim_coord( iris.coords.DimCoord( np.arange( values.shape[1] , dtype = np.int32 ) , long_name = 'member' ) , 1 )
+    cube.add_dim_coord( iris.coords.DimCoord( np.arange( values.shape[2] , dtype = np.int32 ) , long_name = 'time_step' ) , 2 )
+    for index , coord_name in enumerate( [ 'year' , 'month' , 'day' ] ):
+        cube.add_aux_coord( iris.coords.AuxCoord( dates[..., index] , long_name = coord_name ) , ( 0 , 2 ) )
+    cube.attributes.update( { 'Created by' : 'Climate Impacts Metrics Tool' ,
+                              'jobsets' : ' ; '.join( jobset['description'] for jobset in jobsets ) ,
+                              'runids' : ' ; '.join( ','.join( jobset['runids'] ) for jobset in jobsets ) } )
+
+    return cube
+
+# ----------------------------------------------------------------------------------------------------
+
+def write_time_series_csv( outfile , jobsets , values , dates , smoothed = None , smoothed_dates = None , window = 0 , window_type = 'rolling' ):
+    """
+    Writes the stacked series as one long-format csv file, one row per statistic, jobset, member and time step,
+    with the year, month and day of the step.
+    """
+    if os.path.exists( outfile ):
+        print outfile , ' already exists. Please delete existing file first.'
+        return
+
+    statistics = [ ( 'area_mean' , values , dates ) ]
+    if smoothed is not None:
+        statistics.append( ( 'area_mean_' + window_type + '_' + str( window ) , smoothed , smoothed_dates ) )
+
+    print 'Saving csv: ' , outfile
+    with open( outfile , 'wb' ) as csv_file:
+        writer = csv.writer( csv_file )
+        writer.writerow( [ 'statistic' , 'jobset' , 'runid' , 'year' , 'month' , 'day' , 'value' ] )
+
+        for statistic , statistic_values , statistic_dates in statistics:
+            for index , jobset in enumerate( jobsets ):
+                for member , runid in enumerate( jobset['runids'] ):
+                    for step in range( statistic_values.shape[-1] ):
+                        if statistic_dates[index , step , 0] >= 0: # Skip padding
+                            writer.writerow( [ statistic , jobset['description'] , runid ] + list( statistic_dates[index , step] ) +
+                                             [ repr( float( statistic_values[index , member , step] ) ) ] )
@@ -0,0 +1,150 @@
+'''
+cimt_trends.py
+Climate Impact Metrics Tool 'trends' file
+
+Least-squares linear trends for every grid cell at once. The fields of a run are added one year at a
+time to running sums (n, sum t, sum t^2, sum y, sum ty, sum y^2 per cell), from which the slope, its
+p-value and the time of emergence follow in closed form, so only one field and the sums are ever held
+in memory however long the run is. Used by ImpactMetric.trend_analysis().
+'''
+
+import numpy as np
+import scipy.special
+
+# ----------------------------------------------------------------------------------------------------
+# Running sums for the least-squares fit -------------------------------------------------------------
+
+class TrendAccumulator( object ):
+    """
+    Running sums of a least-squares linear fit of every grid cell against the year. Fields can be added
+    in any order and cells missing (masked or NaN) in some years are fitted on their valid years only.
+
+    Times are counted from reference_year and values from the first valid value of each cell, which keeps
+    the sums small enough for the closed-form variances to be accurate in float64.
+
+    Example
+    -------
+    accumulator = TrendAccumulator( 1900 )
+    for year , field in fields:
+        accumulator.add( year , field )
+    fit = accumulator.fit()
+    """
+    def __init__( self , reference_year ):
+        self.reference_year = reference_year
+        self.count = None # Per cell: n, sum t, sum t^2, sum y, sum ty and sum y^2, created with the first field
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def add( self , year , field ):
+        """
+        Adds the field of one year to the sums.
+
+        Parameters
+        ----------
+        year : int
+            The year of the field.
+
+        field : numpy array (or masked array)
+            The field, the same shape every year.
+        """
+        data = np.ma.getdata( field )
+        valid = ~np.ma.getmaskarray( field ) & np.isfinite( data )
+
+        if self.count is None:
+            self.shift = np.where( valid , data , 0 ).astype( np.float64 )
+            self.has_shift = valid.copy()
+            self.count = np.zeros( data.shape , dtype = np.int32 )
+            self.sum_t = np.zeros( data.shape ) ; self.sum_tt = np.zeros( data.shape )
+            self.sum_y = np.zeros( data.shape ) ; self.sum_ty = np.zeros( data.shape ) ; self.sum_yy = np.zeros( data.shape )
+
+        # Cells seen for the first time take this year's value as their shift
+        new = valid & ~self.has_shift
+        if new.any():
+            self.shift[new] = data[new]
+            self.has_shift |= new
+
+        t = float( year - self.reference_year )
+        y = np.subtract( data , self.shift , dtype = np.float64 )
+        y[~valid] = 0
+
+        self.count += valid
+        self.sum_t += t * valid
+        self.sum_tt += t * t * valid
+        self.sum_y += y
+        self.sum_ty += t * y
+        y *= y
+        self.sum_yy += y
+
+    # ----------------------------------------------------------------------------------------------------
+
+    def fit( self ):
+        """
+        Solves the least-squares fit of every cell from the sums.
+
+        Returns
+        -------
+        dictionary of masked arrays
+            'slope' (per year), 'intercept' (at the reference year), 'p_value' (two-sided, of the slope
+            being zero), 'residual_std' (standard deviation of the residuals about the trend) and 'count'
+            (number of years). Cells with fewer than three years, or a single distinct year, are masked.
+        """
+        if self.count is None:
+            raise StandardError( "No fields were added to the trend accumulator" )
+
+        with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+            n = self.count.astype( np.float64 )
+            s_tt = self.sum_tt - self.sum_t * self.sum_t / n # Centred sums
+            s_ty = self.sum_ty - self.sum_t * self.sum_y / n
+            s_yy = self.sum_yy - self.sum_y * self.sum_y / n
+
+            slope = s_ty / s_tt
+            intercept = ( self.sum_y - slope * self.sum_t ) / n + self.shift
+            residual_ss = np.maximum( s_yy - slope * s_ty , 0 )
+            residual_std = np.sqrt( residual_ss / ( n - 2 ) )
+
+            t_statistic = np.abs( slope ) / ( residual_std / np.sqrt( s_tt ) )
+            p_value = 2 * scipy.special.stdtr( n - 2 , -t_statistic )
+            p_value[ ( residual_ss == 0 ) & ( slope != 0 ) ] = 0 # A perfect fit
+            invalid = ( self.count < 3 ) | ~( s_tt > 0 )
+
+        fit = { 'count' : np.ma.masked_array( self.count , mask = invalid ) }
+        for name , values in [ ( 'slope' , slope ) , ( 'intercept' , intercept ) , ( 'p_value' , p_value ) , ( 'residual_std' , residual_std ) ]:
+            fit[name] = np.ma.masked_array( values , mask = invalid | ~np.isfinite( values ) )
+
+        return fit
+
+# ----------------------------------------------------------------------------------------------------
+# Functions derived from the fit ---------------------------------------------------------------------
+
+def time_of_emergence( fit , start_year , end_year , threshold = 2 , significance = 0.05 ):
+    """
+    Computes the time of emergence of every cell: the first year in which the trend, counted from the
+    fitted value in start_year, exceeds threshold times the year-to-year variability (the standard
+    deviation of the residuals about the trend).
+
+    Parameters
+    ----------
+    fit : dictionary
+        As returned by TrendAccumulator.fit().
+
+    start_year , end_year : int
+        The years of the run, emergence after end_year is masked.
+
+    threshold : float
+        Signal-to-noise ratio of emergence.
+        Default setting: threshold = 2.
+
+    significance : float
+        Cells whose trend has a p-value above this level are masked.
+        Default setting: significance = 0.05.
+
+    Returns
+    -------
+    numpy masked array
+        The year of emergence of every cell.
+    """
+    with np.errstate( invalid = 'ignore' , divide = 'ignore' ):
+        emergence = start_year + np.ceil( threshold * fit['residual_std'].filled( np.nan ) / np.abs( fit['slope'].filled( np.nan ) ) )
+        mask = np.ma.getmaskarray( fit['slope'] ) | ~( emergence <= end_year ) | ~( fit['p_value'].filled( 1 ) <= significance )
+
+    return np.ma.masked_array( np.where( mask , 0 , emergence ) , mask = mask )
@@ -4,10 +4,10 @@ Climate Impact Metrics Tool 'utilities' file
 '''
 
 import os
+import sys
 import glob
+import threading
 import iris
-import iris.quickplot as qplt
-import matplotlib.pyplot as plt
 
 # ----------------------------------------------------------------------------------------------------
 # Functions for loading directories ------------------------------------------------------------------
@@ -82,6 +82,270 @@ def get_apm_files( datadir , runid , month ):
     
     return monthly_files
 
+# ----------------------------------------------------------------------------------------------------
+
+def get_subdaily_files( datadir , runid , stream ): 
+    """
+    Creates a list of sub-daily (e.g. 6-hourly or 3-hourly) .pp files from a given directory, sorted chronologically.
+
+    Parameters
+    ----------
+    datadir : string
+        Full path to input .pp files.
+
+    runid : string
+        UM model job name (e.g. 'ajnjm')
+        
+    stream : string
+        UM output stream of the sub-daily files (e.g. 'a.pa')
+
+    Returns
+    -------
+    python list
+        A list of sub-daily file names, chronologically sorted.
+    """
+    subdaily_files = glob.glob( datadir + '/' + runid + '/*' + stream + '*.pp' ) 
+    subdaily_files.sort()
+    
+    return subdaily_files
+
+# ----------------------------------------------------------------------------------------------------
+
+def get_files( datadir , runid , period_type , period , subdaily_streams = None ):
+    """
+    Creates a list of .pp files of a job for a period, using the function for its type of files.
+
+    Parameters
+    ----------
+    datadir : string
+        Full path to input .pp files.
+
+    runid : string
+        UM model job name (e.g. 'ajnjm')
+        
+    period_type : string
+        'annual', 'seasonal', 'monthly' or 'subdaily', as worked out by "cimt_settings.py"
+        
+    period : string
+        String input from the user indicating the types of files, e.g. 'ann' for annual
+        
+    subdaily_streams : dictionary
+        UM output stream for each sub-daily period, e.g. { '6hrly' : 'a.pa' }
+        Default setting: subdaily_streams = None.
+
+    Returns
+    -------
+    python list
+        A list of file names, chronologically sorted.
+    """
+    if period_type == 'annual':
+        return get_apy_files( datadir , runid )
+        
+    elif period_type == 'seasonal':
+        return get_aps_files( datadir , runid , period )
+        
+    elif period_type == 'monthly':
+        raise StandardError("Monthly files available soon!")
+        
+    elif period_type == 'subdaily':
+        return get_subdaily_files( datadir , runid , subdaily_streams[period] )
+        
+    else:
+        raise StandardError("Select a valid period type!")
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for overlapping file reads with computation ----------------------------------------------
+
+def prefetch( items , load_function , depth = 2 , memory_cap = None , sizeof = None ):
+    """
+    Generator which loads items in background threads while the caller is busy with the previous ones,
+    so that disk (or network filesystem) reads overlap with the computation done on each result.
+    
+    Results are always yielded in the same order as the input items, whatever order the loads finish in.
+    Any exception raised by load_function is re-raised in the caller when that item is reached.
+
+    Parameters
+    ----------
+    items : list
+        The items to load, e.g. the job keys of a jobset.
+
+    load_function : function
+        Called as load_function( item ) in a background thread, should return the loaded object.
+        
+    depth : int
+        Maximum number of items loaded ahead of the caller. A depth of 0 disables prefetching and
+        loads each item in the calling thread.
+        Default setting: depth = 2.
+        
+    memory_cap : int
+        Maximum number of bytes held in loaded-but-not-yet-used results, counting the loads in progress.
+        The size of a load isn't known until it finishes, so each load reserves the size of the largest
+        result so far when it starts (and only one load runs until the first result is in). No new loads
+        are started while the reserved and loaded bytes would go over the cap. The item the caller is waiting
+        for is always loaded, so a cap of 0 loads one item at a time in the background. An item much larger
+        than the ones before it can still take the total over the cap.
+        Default setting: memory_cap = None (no cap).
+        
+    sizeof : function
+        Called as sizeof( result ) to obtain the size in bytes of a loaded result, used for memory_cap.
+        Default setting: sizeof = None (results are counted as 0 bytes).
+
+    Returns
+    -------
+    generator
+        Yields ( item , result ) tuples in the order of items.
+    """
+    items = list( items )
+    
+    if depth < 1 or len( items ) < 2: # Nothing to overlap with, load in the calling thread
+        for item in items:
+            yield item , load_function( item )
+        return
+    
+    # Shared state, guarded by the condition
+    # 'bytes' counts the results held and the sizes reserved by the loads in progress
+    state = { 'next_index' : 0 , 'in_flight' : 0 , 'bytes' : 0 , 'estimate' : None , 'results' : {} , 'closed' : False }
+    condition = threading.Condition()
+    
+    def can_start():
+        if state['in_flight'] >= depth:
+            return False
+        if memory_cap != None and state['in_flight'] > 0: # With nothing loading or held, the next item is the one the caller is waiting for
+            if state['estimate'] == None: # Nothing loaded yet, so no idea of the size
+                return False
+            if memory_cap == 0 or state['bytes'] + state['estimate'] > memory_cap:
+                return False
+        return True
+    
+    def worker():
+        while True:
+            with condition:
+                while not state['closed'] and state['next_index'] < len( items ) and not can_start():
+                    condition.wait()
+                if state['closed'] or state['next_index'] >= len( items ):
+                    return
+                index = state['next_index']
+                state['next_index'] += 1
+                state['in_flight'] += 1
+                reserved = state['estimate'] or 0
+                state['bytes'] += reserved
+            
+            try:
+                result = load_function( items[index] )
+                size = sizeof( result ) if sizeof != None else 0
+                outcome = ( True , result , size )
+            except Exception:
+                outcome = ( False , sys.exc_info() , 0 )
+                
+            with condition:
+                state['results'][index] = outcome
+                state['bytes'] += outcome[2] - reserved
+                if outcome[0]:
+                    state['estimate'] = max( state['estimate'] or 0 , outcome[2] )
+                condition.notify_all()
+    
+    threads = []
+    for thread_number in range( min( depth , len( items ) ) ):
+        thread = threading.Thread( target = worker )
+        thread.daemon = True # Don't keep the interpreter alive if the caller gives up
+        thread.start()
+        threads.append( thread )
+    
+    try:
+        for index in range( len( items ) ):
+            with condition:
+                while index not in state['results']:
+                    condition.wait()
+                success , result , size = state['results'].pop( index )
+                state['bytes'] -= size
+                state['in_flight'] -= 1
+                condition.notify_all()
+                
+            if not success:
+                raise result[0] , result[1] , result[2]
+            
+            yield items[index] , result
+            
+    finally:
+        with condition:
+            state['closed'] = True
+            condition.notify_all()
+
+# ----------------------------------------------------------------------------------------------------
+# Functions for keeping memory use down --------------------------------------------------------------
+
+def to_working_precision( cube , dtype , downcast = False ):
+    """
+    Converts the data of a cube to the working precision, without a copy if it is already of that type.
+    Floating point data of a wider type (e.g. float64 netCDF observations with a float32 working precision)
+    is only narrowed if downcast is True, otherwise it keeps its type.
+
+    Parameters
+    ----------
+    cube : iris cube
+        The cube to convert, its data is replaced.
+
+    dtype : numpy dtype
+        The working precision, e.g. numpy.dtype('float32'). None keeps the type of the data.
+        
+    downcast : boolean
+        Also convert floating point data wider than the working precision.
+        Default setting: downcast = False.
+
+    Returns
+    -------
+    iris cube
+        The same cube.
+    """
+    if dtype is None or cube.data.dtype == dtype: # A float64 dtype compares equal to None
+        return cube
+    
+    if cube.data.dtype.kind == 'f' and cube.data.dtype.itemsize > dtype.itemsize and not downcast:
+        return cube
+    
+    cube.data = cube.data.astype( dtype )
+        
+    return cube
+
+# ----------------------------------------------------------------------------------------------------
+
+def scale_in_place( cube , factor , dtype = None , downcast = False ):
+    """
+    Multiplies the data of a cube by a factor in place, rather than with cube * factor which allocates
+    a second full-size array. The data is first converted to the working precision.
+
+    Parameters
+    ----------
+    cube : iris cube
+        The cube to scale, its data is modified.
+
+    factor : int / float
+        The multiplication factor, e.g. a unit_factor.
+        
+    dtype : numpy dtype
+        The working precision, e.g. numpy.dtype('float32'). 
+        Default setting: dtype = None (keep the type of the data).
+        
+    downcast : boolean
+        Also convert floating point data wider than the working precision, see to_working_precision().
+        Default setting: downcast = False.
+
+    Returns
+    -------
+    iris cube
+        The same cube.
+    """
+    to_working_precision( cube , dtype , downcast )
+    
+    if factor != 1:
+        if cube.data.dtype.kind != 'f': # Integer data can't hold the scaled values in place
+            cube.data = cube.data * factor
+        else:
+            data = cube.data
+            data *= factor
+            
+    return cube
+
 # ----------------------------------------------------------------------------------------------------
 # Functions for netCDF files -------------------------------------------------------------------------
 
@@ -132,31 +396,3 @@ def read_netcdf_file( data_dir , file_name ):
     else:
         print infile , 'Does not exist'
     return cube_in
-
-# ----------------------------------------------------------------------------------------------------
-# Functions for plots --------------------------------------------------------------------------------
-
-def save_map_png( data_dir , file_name , cube_out ):
-    """
-    Saves a map plot as a .png file to the output location indicated
-
-    Parameters
-    ----------
-    data_dir : string
-        A full path to output .png location
-
-    file_name : string
-        A meaningful m file name. for example: cube.long_name
-    
-    cube_out : cube
-        The output cube to save
-    """
-    outfile = data_dir + '/' + file_name + '.png'
-    if not os.path.exists( outfile ):
-        print 'Saving Plot: ' , outfile
-        qplt.pcolormesh( cube_out ) # NB- Need more robust plot
-        plt.savefig( outfile )
-        plt.close()
-    else:
-        print outfile , ' already exists. Please delete existing file first.'
-    return
\ No newline at end of file